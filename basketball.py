@@ -1,32 +1,108 @@
 import time
 import datetime
+import multiprocessing
 import numpy as np
 import pandas as pd
 from scipy.optimize import minimize
-from db import datasets, mongo, process_utils
+import instrumentation
+from db import datasets, history, mongo, process_utils
 from models import nba_models as nba
 from models import prediction_utils as pu
+from models import streaming
 from scrape import scrape_utils, team_scraper, player_scraper
 
-class nba_model:
+# Model used by each train_all worker process
+_worker_model = None
 
-    def __init__(self, mw, att_constraint, def_constraint, day_span = 7):
 
-        # Team Information
-        self.nteams = 30
-        self.teams = process_utils.name_teams(False, 30)
+def _init_worker(mw, att_constraint, def_constraint, day_span, solver):
+    """ Give a train_all worker process its own model and Mongo connection. """
 
-        # MongoDB
-        self.mongo = mongo.Mongo()
+    global _worker_model
+    _worker_model = nba_model.from_config(mw, att_constraint, def_constraint, day_span, solver)
 
-        # Model parameters
-        self.mw = mw
-        self.att_constraint = att_constraint
-        self.def_constraint = def_constraint
-        self.day_span = day_span
 
-        self.today = datetime.datetime.now()
-        self.today = pd.Timestamp(self.today.replace(hour=0, minute=0, second=0, microsecond=0))
+def _train_dates(args):
+    """
+    Train a block of consecutive dates in a train_all worker process.
+
+    :param args: Tuple of (dates, teams, players, warm_start, stream)
+    :return: Number of dates trained and the total team iterations
+    """
+
+    dates, teams, players, warm_start, stream = args
+
+    return len(dates), _worker_model.train_dates(dates, teams, players, warm_start, stream)
+
+
+# Player arrays shared with the train_players worker processes
+_player_arrays = None
+
+
+def _init_player_worker(*arrays):
+    """ View the shared player arrays in a train_players worker process. """
+
+    global _player_arrays
+    _player_arrays = [np.frombuffer(array) for array in arrays]
+
+
+def _fit_shared_segments(segments):
+    """
+    Fit player segments in a train_players worker process.
+
+    :param segments: List of (player index, start, end) into the shared arrays
+    :return: List of (player index, a, b)
+    """
+
+    return _fit_segments(segments, *_player_arrays)
+
+
+def _fit_segments(segments, share, weight, pts, team_pts):
+    """
+    Fit each player's beta distribution with scipy.
+
+    :param segments: List of (player index, start, end) into the arrays
+    :param share: Player points divided by team points for each game
+    :param weight: Time decay weight of each game
+    :param pts: Player points
+    :param team_pts: Team points
+    :return: List of (player index, a, b)
+    """
+
+    fits = []
+
+    for i, start, end in segments:
+        a0 = np.array([team_pts[start:end].mean(), (team_pts[start:end] - pts[start:end]).mean()])
+        a, b = nba.fit_player_beta(share[start:end], weight[start:end], a0)
+        fits.append((i, a, b))
+
+    return fits
+
+
+def _shared_array(values):
+    """ Copy a float array into shared memory that worker processes can read without pickling. """
+
+    shared = multiprocessing.RawArray('d', len(values))
+    np.frombuffer(shared)[:] = values
+
+    return shared
+
+
+class nba_model:
+
+    def __init__(self, mw, att_constraint, def_constraint, day_span = 7, jobs = 1, solver = 'SLSQP'):
+        """
+        Args:
+            mw: Time decay factor
+            att_constraint: Mean attack, 'rolling', 'rolling_low' or None
+            def_constraint: Mean defence or None
+            day_span: Number of days in each time decay period
+            jobs: Number of worker processes used to train every date
+            solver: 'SLSQP' fits the team abilities with the mean constraints, any other scipy method with
+                    gradients ('L-BFGS-B', 'Newton-CG') fits them in unconstrained coordinates that always meet them
+        """
+
+        self._setup(mw, att_constraint, def_constraint, day_span, solver)
 
         # Train new abilities if they don't exist in the database
         if self.mongo.count(self.mongo.DIXON_TEAM,
@@ -35,7 +111,7 @@ class nba_model:
                              'def_constraint': self.def_constraint,
                              'day_span': self.day_span}) == 0:
             print('Training Team Abilities')
-            self.train_all(teams = True, players = False)
+            self.train_all(teams = True, players = False, jobs = jobs)
         # ELIF TRAIN MISSING DAYS
         elif self.mongo.count(self.mongo.DIXON_TEAM,
                               {
@@ -47,18 +123,15 @@ class nba_model:
                               }) == 0:
 
             print('Scraping Missing Games')
-            for team in scrape_utils.team_names():
-                team_scraper.season_game_logs(team, 2019)
+            with instrumentation.stage('nba_model.scrape_game_logs'):
+                for team in scrape_utils.team_names():
+                    team_scraper.season_game_logs(team, 2019)
 
 
             print('Training Missing Days (Including Today)')
-            ab = datasets.team_abilities(mw, att_constraint, def_constraint, day_span)
-            games = datasets.game_results([2017, 2018, 2019])
-
-            missing_ab = ab.merge(games, on = 'date', how = 'right')
 
             # Train for the missing dates
-            for date in missing_ab.loc[missing_ab.team.isnull(), 'date'].unique():
+            for date in datasets.untrained_team_dates(mw, att_constraint, def_constraint, day_span, [2017, 2018, 2019]):
                 self.train(pd.Timestamp(date))
 
             # Need to add today as this won't include that
@@ -67,63 +140,219 @@ class nba_model:
         # Train new abilities if they don't exist in the database
         if self.mongo.count(self.mongo.PLAYERS_BETA, {'mw': 0.044, 'day_span': self.day_span}) == 0:
             print('Training Player Abilities')
-            self.train_all(teams = False, players = True)
+            self.train_all(teams = False, players = True, jobs = jobs)
         # ELIF TRAIN MISSING DAYS
         elif self.mongo.count(self.mongo.PLAYERS_BETA, {'mw': 0.044, 'day_span': self.day_span, 'date': self.today}) == 0:
 
-            ab = datasets.player_abilities(0.044, day_span)
-            games = datasets.game_results([2017, 2018, 2019])
-
-            # Determine which games need to be scraped
-            missing_ab = ab.merge(games, on = 'date', how = 'right')
-            missing_ids = missing_ab[missing_ab['mean'].isnull()]['_id'].unique()
+            missing_dates = datasets.untrained_player_dates(0.044, day_span, [2017, 2018, 2019])
 
             # Scrape the missing game logs
             print('Scraping Player Box Scpres')
-            for id in missing_ids:
-                player_scraper.player_box_score(id)
+            with instrumentation.stage('nba_model.scrape_box_scores'):
+                player_scraper.player_box_scores(datasets.game_ids(missing_dates))
+
+            # The history may have been loaded before the box scores were scraped
+            self.history = None
 
             # Train for the missing dates
             print('Train Missing Days')
-            for date in missing_ab.loc[missing_ab.team.isnull(), 'date'].unique():
+            for date in missing_dates:
                 self.train_players(pd.Timestamp(date))
 
             # Need to add today as this won't include that
             self.train_players(self.today)
 
-        # Get all abilities in DF
-        self.abilities = datasets.team_abilities(mw, att_constraint, def_constraint, day_span)
-        self.player_abilities = datasets.player_abilities(0.044, day_span)
+    @property
+    def abilities(self):
+        """ Team abilities of every trained date, loaded from the database on first use. """
+
+        if self._abilities is None:
+            self._abilities = datasets.team_abilities(self.mw, self.att_constraint, self.def_constraint, self.day_span)
+
+        return self._abilities
+
+    @abilities.setter
+    def abilities(self, abilities):
+        self._abilities = abilities
+
+    @property
+    def mongo(self):
+        """ Database wrapper, created on first use so models trained in memory never connect. """
+
+        if self._mongo is None:
+            self._mongo = mongo.Mongo()
+
+        return self._mongo
 
-    def train_all(self, teams = True, players = True):
+    @property
+    def history(self):
+        """ Game results, loaded from the database on first use, and player results once training needs them. """
+
+        if self._history is None:
+            self._history = history.History.load(teams = self.teams)
+
+        return self._history
+
+    @history.setter
+    def history(self, results):
+        self._history = results
+
+    @property
+    def player_abilities(self):
+        """ Player abilities of every trained date, loaded from the database on first use. """
+
+        if self._player_abilities is None:
+            self._player_abilities = datasets.player_abilities(0.044, self.day_span)
+
+        return self._player_abilities
+
+    @player_abilities.setter
+    def player_abilities(self, player_abilities):
+        self._player_abilities = player_abilities
+
+    def _setup(self, mw, att_constraint, def_constraint, day_span, solver = 'SLSQP'):
+
+        # Team Information
+        self.nteams = 30
+        self.teams = process_utils.name_teams(False, 30)
+
+        # MongoDB, connected when it is first used
+        self._mongo = None
+
+        # Model parameters
+        self.mw = mw
+        self.att_constraint = att_constraint
+        self.def_constraint = def_constraint
+        self.day_span = day_span
+        self.solver = solver
+
+        self.today = datetime.datetime.now()
+        self.today = pd.Timestamp(self.today.replace(hour=0, minute=0, second=0, microsecond=0))
+
+        # Abilities are loaded when they are first used
+        self._abilities = None
+        self._player_abilities = None
+
+        # Results are loaded once when training first needs them
+        self._history = None
+
+    @classmethod
+    def from_config(cls, mw, att_constraint, def_constraint, day_span = 7, solver = 'SLSQP'):
+        """
+        Create a model without checking, training or loading abilities from the database.
+        """
+
+        model = cls.__new__(cls)
+        model._setup(mw, att_constraint, def_constraint, day_span, solver)
+
+        return model
+
+    def train_all(self, teams = True, players = True, warm_start = True, jobs = 1, stream = True):
         """
         Train parameters for all weeks.
 
         Args:
             teams: Boolean - Train teams parameters if True
             players: Boolean - Train player parameters if True
+            warm_start: Boolean - Start each team fit from the previous date's abilities if True
+            jobs: Number of worker processes, dates are split into blocks of consecutive days
+            stream: Boolean - Update the decayed statistics from one date to the next instead of rebuilding them
+
+        """
+
+        dates = self.history.dates([2017, 2018, 2019])
+
+        iterations = 0
+
+        instrumentation.count('nba_model.train_all', 'dates', len(dates))
+
+        if jobs > 1:
+
+            # Consecutive dates stay together so each worker can still warm start from its previous day
+            size = max(1, int(np.ceil(len(dates) / (jobs * 4))))
+            blocks = [(dates[i:i + size], teams, players, warm_start, stream) for i in range(0, len(dates), size)]
+
+            pool = multiprocessing.Pool(jobs, _init_worker,
+                                        (self.mw, self.att_constraint, self.def_constraint, self.day_span, self.solver))
+
+            trained = 0
+            try:
+                for ntrained, nit in pool.imap_unordered(_train_dates, blocks):
+                    trained += ntrained
+                    iterations += nit
+                    print('Trained %d/%d dates' % (trained, len(dates)))
+            finally:
+                pool.close()
+                pool.join()
+
+        else:
+            iterations = self.train_dates(dates, teams, players, warm_start, stream)
+
+        if teams:
+            print('Total team iterations (%s start):' % ('warm' if warm_start else 'flat'), iterations)
+
+    def train_dates(self, dates, teams = True, players = True, warm_start = True, stream = True):
+        """
+        Train parameters for consecutive dates.
+
+        Args:
+            dates: Increasing list of dates
+            teams: Boolean - Train teams parameters if True
+            players: Boolean - Train player parameters if True
+            warm_start: Boolean - Start each team fit from the previous date's abilities if True
+            stream: Boolean - Update the decayed statistics from one date to the next instead of rebuilding them
 
+        Returns:
+            The total team iterations
         """
 
-        # Train every date in dataset
-        for date in datasets.game_results([2017, 2018, 2019])['date'].unique():
+        team_stream = None
+        player_stream = None
+
+        if stream:
+            with instrumentation.stage('nba_model.stream_setup'):
+                if teams:
+                    team_stream = streaming.TeamStream(self.history.games, self.nteams, self.day_span, self.mw)
+                if players:
+                    player_stream = streaming.PlayerStream(self.history.players, self.day_span, self.mw)
+
+        iterations = 0
+
+        for date in dates:
 
             # Train Team Poisson Distributions
             if teams:
-                self.train(pd.Timestamp(date))
+                likelihood = None
+                if stream:
+                    with instrumentation.stage('train.window'):
+                        likelihood = team_stream.likelihood(date)
+                iterations += self.train(date, warm_start = warm_start, likelihood = likelihood).nit
 
             # Train Player Beta Distributions
             if players:
-                self.train_players(pd.Timestamp(date))
+                self.train_players(date, stream = player_stream)
+
+        return iterations
 
-    def train_players(self, date = None, years_to_keep = 2):
+    def train_players(self, date = None, years_to_keep = 2, method = 'batch', jobs = 1, stream = None):
+        """
+        Train the beta distribution of every player's share of team points.
+
+        Args:
+            date: Train with the games before this date
+            years_to_keep: Number of years of games to train with
+            method: 'batch' fits every player at once with Newton's method and uses scipy only for players that
+                    do not converge, 'scipy' fits every player with scipy
+            jobs: Number of worker processes for the scipy fits
+            stream: streaming.PlayerStream to take the player statistics from instead of the window
+
+        """
 
         if date is None:
             date = self.today
 
-        # Only keep the last two seasons
-        df = datasets.player_results(date = date)
-        df = df[((date - df['date']).dt.days) < (365*2)]
+        # Only keep the last seasons
+        df = self.history.player_window(date, years_to_keep)
 
         self.mongo.remove(
             self.mongo.PLAYERS_BETA,
@@ -136,65 +365,204 @@ class nba_model:
 
         print(date)
 
-        con = [{'type': 'ineq', 'fun': lambda x: x[0]}, {'type': 'ineq', 'fun': lambda x: x[1]}]
+        with instrumentation.stage('train_players.window'):
+            if stream is None:
+                names, teams, stats = self._player_stats(df, date)
+            else:
+                names, teams, stats = stream.stats(date)
 
-        df.loc[df.pts == 0, 'pts'] = 0.001
-        for name, games in df.groupby('player'):
+        instrumentation.count('train_players.window', 'rows', len(df))
+        instrumentation.count('train_players.window', 'players', len(names))
+
+        with instrumentation.stage('train_players.fit'):
+            if method == 'batch':
+                a, b, converged = nba.fit_player_betas(*stats)
+                fallback = np.flatnonzero(~converged)
+            else:
+                a = np.zeros(len(names))
+                b = np.zeros(len(names))
+                fallback = np.arange(len(names))
+
+        if len(fallback) > 0:
+            with instrumentation.stage('train_players.scipy'):
+                for i, player_a, player_b in self._fit_players_scipy(df, date, names, fallback, jobs):
+                    a[i] = player_a
+                    b[i] = player_b
+
+            instrumentation.count('train_players.scipy', 'players', len(fallback))
+
+        players = []
+
+        for i, name in enumerate(names):
 
             player = {'date': date, 'mw': 0.044, 'day_span': 7}
 
-            a0 = np.array([games.team_pts.mean(), (games.team_pts - games.pts).mean()])
+            player['player'] = {'name': str(name), 'a': a[i], 'b': b[i], 'team': teams[i]}
+
+            players.append(player)
+
+        with instrumentation.stage('train_players.store'):
+            self.mongo.insert_many(self.mongo.PLAYERS_BETA, players)
+
+        instrumentation.count('train_players.store', 'documents', len(players))
+
+    def _player_stats(self, df, date):
+        """
+        Beta likelihood statistics of every player in a window.
+
+        Args:
+            df: Player results in the window, sorted by date
+            date: Train with the games before this date
+
+        Returns:
+            Player names, the team of each player's latest game and the tuple of nba_models.player_beta_stats arrays
+        """
+
+        codes, names = pd.factorize(df['player'], sort = True)
+
+        share = (df['pts'] / df['team_pts']).values
+        weight = nba.decay_weights(df, date, self.day_span, self.mw)
+
+        # The window is sorted by date, so the last team is from the latest game
+        teams = df.groupby('player')['team'].last().reindex(names).values
+
+        return names, teams, nba.player_beta_stats(share, weight, codes, len(names))
+
+    def _fit_players_scipy(self, df, date, names, players, jobs = 1):
+        """
+        Fit players one at a time with scipy.
+
+        Args:
+            df: Player results in the window
+            date: Train with the games before this date
+            names: Player names
+            players: Indices into names of the players to fit
+            jobs: Number of worker processes
+
+        Returns:
+            List of (player index, a, b)
+        """
+
+        codes = pd.Categorical(df['player'], categories = names[players]).codes
+        df = df[codes >= 0]
+        codes = codes[codes >= 0]
 
-            opt = minimize(nba.player_beta, x0=a0, args=(games, date, self.day_span, self.mw), constraints = con)
+        # Each player's games are one contiguous segment of the arrays
+        order = np.argsort(codes, kind = 'mergesort')
+        codes = codes[order]
+        df = df.iloc[order]
+        bounds = np.searchsorted(codes, np.arange(len(players) + 1))
 
-            player['player'] = {'name': str(name), 'a': opt.x[0], 'b': opt.x[1], 'team': games[games.date == games.date.max()]['team'].to_string(index = False)}
+        share = (df['pts'] / df['team_pts']).values
+        weight = nba.decay_weights(df, date, self.day_span, self.mw)
+        team_pts = df['team_pts'].values.astype(float)
+        pts = df['pts'].values.astype(float)
 
-            self.mongo.insert(self.mongo.PLAYERS_BETA, player)
+        segments = [(i, bounds[j], bounds[j + 1]) for j, i in enumerate(players)]
 
-    def train(self, date = None, years_to_keep = 2):
+        if jobs > 1 and len(segments) > 1:
+
+            # Players are sent in chunks, the arrays themselves are shared instead of pickled
+            size = max(1, int(np.ceil(len(segments) / (jobs * 4))))
+            chunks = [segments[i:i + size] for i in range(0, len(segments), size)]
+
+            pool = multiprocessing.Pool(jobs, _init_player_worker,
+                                        [_shared_array(array) for array in (share, weight, pts, team_pts)])
+            try:
+                return [fit for chunk in pool.imap_unordered(_fit_shared_segments, chunks) for fit in chunk]
+            finally:
+                pool.close()
+                pool.join()
+
+        return _fit_segments(segments, share, weight, pts, team_pts)
+
+    def train(self, date = None, years_to_keep = 2, warm_start = True, likelihood = None, store = True, x0 = None):
+        """
+        Train the team abilities for a date.
+
+        Args:
+            date: Train with the games before this date
+            years_to_keep: Number of years of games to train with
+            warm_start: Boolean - Start from the latest stored abilities before the date if True
+            likelihood: nba_models.DixonColes of the window, built from the history if None
+            store: Boolean - Replace the date's abilities in the database if True
+            x0: Initial parameters, used instead of the stored abilities
+
+        Returns:
+            The scipy OptimizeResult
+        """
 
         if date is None:
             date = self.today
 
-        # Only keep the last two seasons
-        df = datasets.game_results(teams = self.teams, date = date)
-        df = df[((date - df['date']).dt.days) < (365*years_to_keep)]
-
         # Remove abilities from DB
-        self.mongo.remove(self.mongo.DIXON_TEAM,
-                          {
-                            'mw': self.mw,
-                            'att_constraint': self.att_constraint,
-                            'def_constraint': self.def_constraint,
-                            'day_period': self.day_span,
-                            'date': date
-                          })
-
-        # Initial Guess
-        a0 = pu.initial_guess(0, self.nteams)
+        if store:
+            self.mongo.remove(self.mongo.DIXON_TEAM,
+                              {
+                                'mw': self.mw,
+                                'att_constraint': self.att_constraint,
+                                'def_constraint': self.def_constraint,
+                                'day_span': self.day_span,
+                                'date': date
+                              })
+
+        # Initial Guess, the nearest earlier abilities are almost identical so start from them if they exist
+        previous = None
+        if x0 is None and warm_start:
+            previous = datasets.previous_team_abilities(self.mw, self.att_constraint, self.def_constraint,
+                                                        self.day_span, date)
+
+        if x0 is not None:
+            a0 = x0
+        elif previous is not None:
+            a0 = pu.abilities_to_params(previous, self.teams)
+        else:
+            a0 = pu.initial_guess(0, self.nteams)
+
+        # Team indices, weights and log-factorials are fixed for the whole optimization, and games between the
+        # same teams are combined
+        if likelihood is None:
+            with instrumentation.stage('train.window'):
+                df = self.history.game_window(date, years_to_keep)
+                likelihood = nba.DixonColes.from_games(df, self.nteams, date, self.day_span, self.mw).compressed()
+
+            instrumentation.count('train.window', 'rows', len(df))
 
         if self.att_constraint == 'rolling':
-            weight = np.exp(-self.mw * np.ceil(((date - df['date']).dt.days) / self.day_span))
-            att_constraint = np.average(df['away_pts'], weights = weight)
+            att_constraint = np.average(likelihood.away_pts, weights = likelihood.weight)
         elif self.att_constraint == 'rolling_low':
-            weight = np.exp(-self.mw * np.ceil(((date - df['date']).dt.days) / self.day_span))
-            att_constraint = np.floor((np.average(df['away_pts'], weights = weight) + 100)/2)
+            att_constraint = np.floor((np.average(likelihood.away_pts, weights = likelihood.weight) + 100)/2)
 
         else:
             att_constraint = self.att_constraint
 
         con = []
 
-        print(date, att_constraint)
-
         if self.att_constraint is not None:
-            con.append({'type': 'eq', 'fun': pu.attack_constraint, 'args': (round(att_constraint), self.nteams,)})
+            con.append({'type': 'eq', 'fun': pu.attack_constraint, 'jac': pu.attack_constraint_jac,
+                        'args': (round(att_constraint), self.nteams,)})
 
         if self.def_constraint is not None:
-            con.append({'type': 'eq', 'fun': pu.defense_constraint, 'args': (round(self.def_constraint), self.nteams,)})
+            con.append({'type': 'eq', 'fun': pu.defense_constraint, 'jac': pu.defense_constraint_jac,
+                        'args': (round(self.def_constraint), self.nteams,)})
 
         # Get team parameters for the current week
-        opt = minimize(nba.dixon_coles, x0=a0, args=(df, self.nteams, date, self.day_span, self.mw), constraints = con, method='SLSQP')
+        with instrumentation.stage('train.optimize'):
+            if self.solver == 'SLSQP':
+                opt = minimize(likelihood.gradient, x0=a0, jac=True, constraints = con, method='SLSQP')
+            else:
+                opt = nba.minimize_unconstrained(
+                    likelihood.gradient, a0,
+                    round(att_constraint) if self.att_constraint is not None else None,
+                    round(self.def_constraint) if self.def_constraint is not None else None,
+                    self.nteams, method = self.solver)
+
+        instrumentation.optimizer('train.optimize', opt)
+
+        print(date, att_constraint, 'flat' if previous is None and x0 is None else 'warm', 'iterations:', opt.nit)
+
+        if not store:
+            return opt
 
         abilities = pu.convert_abilities(opt.x, self.teams)
 
@@ -207,7 +575,10 @@ class nba_model:
         abilities['def_constraint'] = self.def_constraint
         abilities['date'] = date
 
-        self.mongo.insert(self.mongo.DIXON_TEAM, abilities)
+        with instrumentation.stage('train.store'):
+            self.mongo.insert(self.mongo.DIXON_TEAM, abilities)
+
+        return opt
 
 
     def predict(self, dataset = None, seasons = None, keep_abilities = False, players = False, player_penalty = 0.22, top_players = 1):
@@ -248,28 +619,17 @@ class nba_model:
             # Get the players who played in a game, not just best player
             pr = datasets.player_results().astype(str)
 
-            # Iterate through each game and apply penalty if best player is missing
-            for game in games.itertuples():
-
-                players = pr[pr._id==game._1]['player'].values
-
-                # Home Penalty
-                bp = player_abilities.loc[(player_abilities.team == game.home_team) & (player_abilities.date == game.date)]
-                penalty = 1 - (bp['mean'] * ~bp['name'].isin(players) * player_penalty)
-                games.loc[games._id == game._1, 'home_mean'] = penalty.cumprod().min() * games.loc[games._id == game._1, 'home_mean']
+            # Apply a penalty to every game where the best players are missing
+            home_penalty, away_penalty = pu.missing_player_penalty(games, player_abilities, pr, player_penalty)
 
-                # Away Penalty
-                bp = player_abilities.loc[(player_abilities.team == game.away_team) & (player_abilities.date == game.date)]
-                penalty = 1 - (bp['mean'] * ~bp['name'].isin(players) * player_penalty)
-                games.loc[games._id == game._1, 'away_mean'] = penalty.cumprod().min() * games.loc[games._id == game._1, 'away_mean']
+            games['home_mean'] = home_penalty * games['home_mean']
+            games['away_mean'] = away_penalty * games['away_mean']
 
-        # Win probabilities
-        hprob = np.zeros(len(games))
-        aprob = np.zeros(len(games))
+        # Win probabilities for every game at once
+        with instrumentation.stage('predict.probabilities'):
+            hprob, aprob = pu.win_probabilities(games['home_mean'].values, games['away_mean'].values)
 
-        # Iterate through each game to determine the winner and prediction
-        for row in games.itertuples():
-            hprob[row.Index], aprob[row.Index] = pu.determine_probabilities(row.home_mean, row.away_mean)
+        instrumentation.count('predict.probabilities', 'games', len(games))
 
         # Scale odds so they sum up to 1
         scale = 1 / (hprob + aprob)
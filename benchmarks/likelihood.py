@@ -0,0 +1,81 @@
+""" Per call timings of the likelihood functions against their precompiled counterparts. """
+
+import timeit
+import numpy as np
+import pandas as pd
+from models import nba_models as nba
+
+
+def random_games(ngames, nteams=30, seed=0):
+    """
+    Random results shaped like datasets.game_results(teams=...)
+
+    :param ngames: Number of games
+    :param nteams: Number of teams
+    :param seed: Random seed
+    :return: DataFrame of games
+    """
+
+    rand = np.random.RandomState(seed)
+
+    home = rand.randint(0, nteams, ngames)
+    away = (home + rand.randint(1, nteams, ngames)) % nteams
+
+    return pd.DataFrame({'home_team': home,
+                         'away_team': away,
+                         'home_pts': rand.poisson(110, ngames),
+                         'away_pts': rand.poisson(105, ngames),
+                         'pts': rand.randint(1, 30, ngames),
+                         'team_pts': rand.poisson(110, ngames),
+                         'date': pd.Timestamp('2017-10-17') + pd.to_timedelta(rand.randint(0, 730, ngames), unit='D')})
+
+
+def time_call(func, number):
+    """ Best per call time in microseconds. """
+
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main(ngames=2460, nteams=30, day_span=7, decay=0.044):
+
+    games = random_games(ngames, nteams)
+    date = games['date'].max() + pd.Timedelta(days=1)
+
+    params = np.random.RandomState(1).uniform(0.9, 1.1, nteams * 3)
+    params[:nteams] *= 100
+
+    dixon_coles = nba.DixonColes.from_games(games, nteams, date, day_span, decay)
+    compressed = dixon_coles.compressed()
+    player = nba.PlayerBeta.from_games(games, date, day_span, decay)
+    ab = np.array([5.0, 40.0])
+
+    rows = [
+        ('dixon_coles', time_call(lambda: nba.dixon_coles(params, games, nteams, date, day_span, decay), 50),
+         time_call(lambda: dixon_coles(params), 500)),
+        ('dixon_coles_grad', time_call(lambda: nba.dixon_coles_grad(params, games, nteams, date, day_span, decay), 50),
+         time_call(lambda: dixon_coles.gradient(params), 500)),
+        ('player_beta', time_call(lambda: nba.player_beta(ab, games, date, day_span, decay), 50),
+         time_call(lambda: player(ab), 500)),
+    ]
+
+    print('%d games, %d teams' % (ngames, nteams))
+    print('%-18s %12s %12s %8s' % ('likelihood', 'function us', 'class us', 'speedup'))
+    for name, old, new in rows:
+        print('%-18s %12.1f %12.1f %7.1fx' % (name, old, new, old / new))
+
+    rows = [
+        ('dixon_coles', time_call(lambda: dixon_coles(params), 500), time_call(lambda: compressed(params), 500)),
+        ('dixon_coles_grad', time_call(lambda: dixon_coles.gradient(params), 500),
+         time_call(lambda: compressed.gradient(params), 500)),
+    ]
+
+    print()
+    print('%d games in %d pairs, difference %.2e' % (ngames, len(compressed.home),
+                                                   abs(dixon_coles(params) - compressed(params))))
+    print('%-18s %12s %12s %8s' % ('likelihood', 'games us', 'pairs us', 'speedup'))
+    for name, old, new in rows:
+        print('%-18s %12.1f %12.1f %7.1fx' % (name, old, new, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+""" Parse time per page of the BeautifulSoup and lxml parsers on pages saved in the page archive. """
+
+import glob
+import json
+import os
+import sys
+import time
+from scrape import page_archive, player_scraper, team_scraper
+
+# Parser for each kind of page, chosen by the url
+PARSERS = [
+    ('/gamelog', 'game log', lambda content, url, fast: team_scraper.parse_game_logs(
+        content, url.split('/')[-3], int(url.split('/')[-2]), fast=fast)),
+    ('/boxscores/2', 'box score', lambda content, url, fast: player_scraper.parse_box_score(content, fast=fast)),
+    ('stats_per_game_totals', 'season stats', lambda content, url, fast: team_scraper.parse_team_season_stats(
+        content, fast=fast)),
+]
+
+
+def archived_pages(archive_dir):
+    """
+    Urls of every page in the archive
+
+    :param archive_dir: Page archive directory
+    :return: List of urls
+    """
+
+    urls = []
+
+    for meta_file in glob.glob(os.path.join(archive_dir, '*', '*.json')):
+        with open(meta_file) as f:
+            urls.append(json.load(f)['url'])
+
+    return urls
+
+
+def main(archive_dir=page_archive.ARCHIVE_DIR, limit=200):
+
+    results = {}
+
+    for url in archived_pages(archive_dir):
+
+        for pattern, kind, parse in PARSERS:
+            if pattern not in url:
+                continue
+
+            stats = results.setdefault(kind, {'pages': 0, 'soup': 0.0, 'lxml': 0.0, 'different': 0})
+            if stats['pages'] >= limit:
+                break
+
+            content = page_archive.read(url)[0]
+
+            start = time.perf_counter()
+            soup = parse(content, url, False)
+            stats['soup'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            fast = parse(content, url, True)
+            stats['lxml'] += time.perf_counter() - start
+
+            # The stored documents must not change
+            if repr(soup) != repr(fast):
+                stats['different'] += 1
+                print('Different documents:', url)
+
+            stats['pages'] += 1
+            break
+
+    print('%-14s %6s %12s %12s %8s %10s' % ('page', 'pages', 'soup ms', 'lxml ms', 'speedup', 'different'))
+    for kind, stats in sorted(results.items()):
+        soup = stats['soup'] / stats['pages'] * 1000
+        fast = stats['lxml'] / stats['pages'] * 1000
+        print('%-14s %6d %12.2f %12.2f %7.1fx %10d' % (kind, stats['pages'], soup, fast, soup / fast, stats['different']))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
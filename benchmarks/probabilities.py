@@ -0,0 +1,30 @@
+""" Timings of the per game win probability function against the batched version. """
+
+import time
+import numpy as np
+from models import prediction_utils as pu
+
+
+def main(ngames=3690, sample=100):
+
+    rand = np.random.RandomState(0)
+    hmean = rand.uniform(90, 125, ngames)
+    amean = rand.uniform(90, 125, ngames)
+
+    # The per game function is too slow to run on a full backtest, so time a sample
+    start = time.perf_counter()
+    for h, a in zip(hmean[:sample], amean[:sample]):
+        pu.determine_probabilities(h, a)
+    per_game = (time.perf_counter() - start) / sample
+
+    start = time.perf_counter()
+    hprob, aprob = pu.win_probabilities(hmean, amean)
+    batched = time.perf_counter() - start
+
+    print('%d games (three seasons)' % ngames)
+    print('determine_probabilities: %.2f s (estimated from %d games)' % (per_game * ngames, sample))
+    print('win_probabilities:       %.3f s' % batched)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+""" Team ability fits with SLSQP and the mean constraints against the unconstrained solvers. """
+
+import time
+import warnings
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+from benchmarks.likelihood import random_games
+from models import nba_models as nba
+from models import prediction_utils as pu
+
+
+def slsqp(likelihood, x0, att_constraint, def_constraint, nteams):
+    """ The constrained fit of nba_model.train. """
+
+    con = [{'type': 'eq', 'fun': pu.attack_constraint, 'jac': pu.attack_constraint_jac,
+            'args': (att_constraint, nteams,)},
+           {'type': 'eq', 'fun': pu.defense_constraint, 'jac': pu.defense_constraint_jac,
+            'args': (def_constraint, nteams,)}]
+
+    return minimize(likelihood.gradient, x0=x0, jac=True, constraints=con, method='SLSQP')
+
+
+def main(sizes=(1230, 2460, 4920), nteams=30, day_span=7, decay=0.044, att_constraint=100, def_constraint=1,
+         repeat=3):
+
+    solvers = [
+        ('SLSQP', slsqp),
+        ('L-BFGS-B', lambda likelihood, *args: nba.minimize_unconstrained(likelihood.gradient, *args,
+                                                                            method='L-BFGS-B')),
+        ('Newton-CG', lambda likelihood, *args: nba.minimize_unconstrained(likelihood.gradient, *args,
+                                                                             method='Newton-CG')),
+    ]
+
+    print('%6s %-10s %10s %6s %6s %18s %12s %10s' % ('games', 'solver', 'ms', 'nit', 'nfev', 'likelihood',
+                                                   'vs SLSQP', 'max diff'))
+
+    for ngames in sizes:
+
+        games = random_games(ngames, nteams)
+        date = games['date'].max() + pd.Timedelta(days=1)
+
+        likelihood = nba.DixonColes.from_games(games, nteams, date, day_span, decay).compressed()
+        x0 = pu.initial_guess(0, nteams)
+
+        reference = None
+
+        for name, solver in solvers:
+
+            times = []
+            for i in range(repeat):
+                start = time.perf_counter()
+
+                # The line searches can step outside the domain and log a warning
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    opt = solver(likelihood, x0, att_constraint, def_constraint, nteams)
+
+                times.append(time.perf_counter() - start)
+
+            if reference is None:
+                reference = opt
+
+            print('%6d %-10s %10.1f %6d %6d %18.6f %12.2e %10.2e' % (
+                ngames, name, min(times) * 1000, opt.nit, opt.nfev, opt.fun, opt.fun - reference.fun,
+                np.abs(opt.x - reference.x).max()))
+
+
+if __name__ == '__main__':
+    main()
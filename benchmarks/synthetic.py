@@ -0,0 +1,378 @@
+""" Synthetic league generator and a benchmark suite over league sizes and history lengths. """
+
+import datetime
+import json
+import os
+import platform
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from basketball import nba_model
+from db import process_utils
+from db.history import History
+from models import nba_models as nba
+from models import prediction_utils as pu
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+class League:
+    """
+    Results of a league simulated from known abilities.
+
+    The attack mean is 100 and the defence mean is 1 so the abilities meet the default model constraints.
+    """
+
+    def __init__(self, teams, attack, defence, home_adv, games, players, player_params):
+        """
+        :param teams: Team names
+        :param attack: Attack ability of each team
+        :param defence: Defence ability of each team
+        :param home_adv: Home advantage of each team
+        :param games: DataFrame shaped like datasets.game_results with the bookmaker odds of each game
+        :param players: DataFrame shaped like datasets.player_results
+        :param player_params: DataFrame of the player, a and b of each player's share of team points
+        """
+
+        self.teams = teams
+        self.attack = attack
+        self.defence = defence
+        self.home_adv = home_adv
+        self.games = games
+        self.players = players
+        self.player_params = player_params
+
+    @property
+    def params(self):
+        """ The abilities as Dixon Coles parameters. """
+
+        return np.concatenate([self.attack, self.defence, self.home_adv])
+
+    def indexed_games(self):
+        """ Game results with team indices, like datasets.game_results(teams=...). """
+
+        return self.games.assign(home_team=process_utils.team_index(self.games['home_team'], self.teams),
+                                 away_team=process_utils.team_index(self.games['away_team'], self.teams))
+
+    def game_log(self):
+        """ The games as game_log documents. """
+
+        players = {key: group for key, group in self.players.groupby(['_id', 'team'])}
+
+        docs = []
+
+        for game in self.games.to_dict('records'):
+
+            doc = {'_id': game['_id'],
+                   'date': game['date'].to_pydatetime(),
+                   'season': int(game['season']),
+                   'home': {'team': game['home_team'], 'pts': int(game['home_pts'])},
+                   'away': {'team': game['away_team'], 'pts': int(game['away_pts'])},
+                   'odds': {'sportsbooks': [{'sportsbook': 'Synthetic',
+                                             'home_odds': float(game['home_odds']),
+                                             'away_odds': float(game['away_odds'])}]}}
+
+            for key, team in (('hplayers', game['home_team']), ('aplayers', game['away_team'])):
+                box_score = players[(game['_id'], team)]
+                doc[key] = [{'player': player, 'pts': int(pts)}
+                            for player, pts in zip(box_score['player'], box_score['pts'])]
+
+            docs.append(doc)
+
+        return docs
+
+
+def generate_league(nteams=30, seasons=2, games_per_season=None, players_per_team=8, margin=0.04, seed=0):
+    """
+    Simulate a league.
+
+    :param nteams: Number of teams
+    :param seasons: Number of seasons
+    :param games_per_season: Games in each season, 41 home games per team by default
+    :param players_per_team: Players on each team
+    :param margin: Bookmaker margin on the true win probabilities
+    :param seed: Random seed
+    :return: League
+    """
+
+    rand = np.random.RandomState(seed)
+
+    if games_per_season is None:
+        games_per_season = nteams * 41
+
+    teams = process_utils.name_teams(True, nteams)
+
+    # Abilities that meet the attack and defence constraints exactly
+    attack = rand.normal(100, 4, nteams)
+    attack += 100 - attack.mean()
+    defence = rand.normal(1, 0.04, nteams)
+    defence += 1 - defence.mean()
+    home_adv = rand.normal(1.02, 0.01, nteams)
+
+    frames = []
+    first_year = 2019 - seasons
+
+    for i in range(seasons):
+
+        # Regular seasons run for about 165 days from late October
+        opening = pd.Timestamp('%d-10-16' % (first_year + i))
+        date = opening + pd.to_timedelta(np.sort(rand.randint(0, 165, games_per_season)), unit='D')
+
+        home = rand.randint(0, nteams, games_per_season)
+        away = (home + rand.randint(1, nteams, games_per_season)) % nteams
+
+        frames.append(pd.DataFrame({'date': date, 'season': first_year + i + 1, 'home': home, 'away': away}))
+
+    schedule = pd.concat(frames, ignore_index=True)
+    home = schedule['home'].values
+    away = schedule['away'].values
+
+    hmean = attack[home] * defence[away] * home_adv[home]
+    amean = attack[away] * defence[home]
+
+    home_pts = rand.poisson(hmean)
+    away_pts = rand.poisson(amean)
+
+    # Overtime until someone wins
+    ties = home_pts == away_pts
+    while ties.any():
+        home_pts[ties] += rand.poisson(hmean[ties] * 5 / 48)
+        away_pts[ties] += rand.poisson(amean[ties] * 5 / 48)
+        ties = home_pts == away_pts
+
+    # Bookmaker odds from the true probabilities
+    hprob, aprob = pu.win_probabilities(hmean, amean)
+    scale = (1 + margin) / (hprob + aprob)
+
+    names = np.asarray(teams)
+
+    # Ids like basketball reference's, numbered when a team is home twice in a day
+    number = schedule.groupby(['date', 'home']).cumcount().values
+
+    games = pd.DataFrame({
+        '_id': ['%s%d%s' % (date.strftime('%Y%m%d'), n, team)
+                for date, n, team in zip(schedule['date'], number, names[home])],
+        'date': schedule['date'],
+        'season': schedule['season'],
+        'home_team': names[home],
+        'away_team': names[away],
+        'home_pts': home_pts,
+        'away_pts': away_pts,
+        'home_odds': np.round(1 / (hprob * scale), 2),
+        'away_odds': np.round(1 / (aprob * scale), 2)
+    })
+
+    # Each player's share of the team points is beta distributed
+    player_names = np.array(['%s Player %d' % (team, i) for team in teams for i in range(players_per_team)])
+    share = rand.uniform(0.04, 0.2, len(player_names))
+    concentration = rand.uniform(20, 60, len(player_names))
+    player_params = pd.DataFrame({'player': player_names, 'a': share * concentration,
+                                  'b': (1 - share) * concentration})
+
+    frames = []
+
+    for side, pts in (('home_team', home_pts), ('away_team', away_pts)):
+
+        team = process_utils.team_index(games[side], teams)
+
+        # Every player of the team plays every game
+        game = np.repeat(np.arange(len(games)), players_per_team)
+        player = (team[:, None] * players_per_team + np.arange(players_per_team)).ravel()
+
+        shares = rand.beta(player_params['a'].values[player], player_params['b'].values[player])
+
+        frames.append(pd.DataFrame({'_id': games['_id'].values[game],
+                                    'date': games['date'].values[game],
+                                    'season': games['season'].values[game],
+                                    'team': games[side].values[game],
+                                    'player': player_names[player],
+                                    'team_pts': pts[game],
+                                    'pts': np.round(shares * pts[game])}))
+
+    players = pd.concat(frames, ignore_index=True)
+
+    return League(teams, attack, defence, home_adv, games, players, player_params)
+
+
+def measure(func, repeat=3):
+    """
+    Time a function and measure the peak memory it allocates.
+
+    :param func: Function without arguments
+    :param repeat: Number of timed calls, the best is kept
+    :return: Seconds, peak bytes and the result of the function
+    """
+
+    times = []
+
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+
+    # tracemalloc slows everything down so the peak is measured on a separate call
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(times), peak, result
+
+
+def league_model(league, history, mw=0.044, day_span=7):
+    """ Model of a synthetic league that trains from the history without the database. """
+
+    model = nba_model.from_config(mw, 100, 1, day_span)
+    model.nteams = len(league.teams)
+    model.teams = league.teams
+    model.history = history
+
+    return model
+
+
+def benchmark(nteams, seasons, repeat=3, seed=0):
+    """
+    Benchmark one league size and history length.
+
+    :return: List of result records
+    """
+
+    league = generate_league(nteams, seasons, seed=seed)
+    history = History(league.indexed_games(), league.players)
+    model = league_model(league, history)
+
+    date = league.games['date'].max() + pd.Timedelta(days=1)
+    window = history.game_window(date)
+    player_window = history.player_window(date)
+
+    params = league.params
+    likelihood = nba.DixonColes.from_games(window, nteams, date, model.day_span, model.mw)
+
+    records = []
+
+    def record(name, func, error=None, rows=len(window)):
+        seconds, peak, result = measure(func, repeat)
+        records.append({'benchmark': name, 'nteams': nteams, 'seasons': seasons, 'rows': rows,
+                        'seconds': seconds, 'peak_bytes': peak,
+                        'error': error(result) if error is not None else None})
+        return result
+
+    record('dixon_coles', lambda: nba.dixon_coles(params, window, nteams, date, model.day_span, model.mw))
+    record('DixonColes.gradient', lambda: likelihood.gradient(params))
+
+    # One player's games for the per call likelihood, every player for the recovery of the batched fit
+    player = league.player_params['player'].values[0]
+    games = player_window[player_window['player'] == player]
+    record('player_beta', lambda: nba.player_beta(np.array([5.0, 40.0]), games, date, model.day_span, model.mw),
+           rows=len(games))
+
+    def fit_players():
+        names, teams, stats = model._player_stats(player_window, date)
+        a, b, converged = nba.fit_player_betas(*stats)
+        return names, a, b
+
+    def player_error(result):
+        names, a, b = result
+        true = league.player_params.set_index('player').loc[names]
+        return float(np.max(np.abs(a / (a + b) - true['a'] / (true['a'] + true['b']))))
+
+    record('fit_player_betas', fit_players, player_error, rows=len(player_window))
+
+    def train_error(opt):
+        return float(np.max(np.abs(opt.x - league.params) / league.params))
+
+    opt = record('train', lambda: model.train(date, warm_start=False, store=False), train_error)
+
+    # Predict the last season with the final abilities
+    abilities = []
+    test = league.games[league.games['season'] == league.games['season'].max()]
+    for game_date in test['date'].unique():
+        abilities.append(pd.DataFrame({'date': game_date, 'team': league.teams, 'attack': opt.x[:nteams],
+                                       'defence': opt.x[nteams:nteams * 2], 'home_adv': opt.x[nteams * 2:]}))
+    model.abilities = pd.concat(abilities, ignore_index=True)
+
+    predictions = record('predict', lambda: model.predict(test), rows=len(test))
+    record('determine_probabilities', lambda: pu.determine_probabilities(110.0, 105.0), rows=1)
+
+    bets = model.games_to_bet(predictions)
+    record('bet_season', lambda: pu.bet_season(bets.copy(), 1.55, 2.7), rows=len(bets))
+
+    return records
+
+
+def run(sizes=((30, 1), (30, 2), (30, 4), (16, 2), (60, 2)), repeat=3, output=None):
+    """
+    Run the suite and save the results as JSON.
+
+    :param sizes: List of (number of teams, number of seasons)
+    :param repeat: Number of timed calls of each benchmark
+    :param output: File to save, a timestamped file in benchmarks/results by default
+    :return: The results
+    """
+
+    records = []
+
+    for nteams, seasons in sizes:
+        records.extend(benchmark(nteams, seasons, repeat))
+
+    results = {'created': datetime.datetime.now().isoformat(),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'pandas': pd.__version__,
+               'results': records}
+
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, 'synthetic_%s.json' % datetime.datetime.now().strftime('%Y%m%d_%H%M%S'))
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    report(records)
+    print('Saved', output)
+
+    return results
+
+
+def report(records, baseline=None):
+    """
+    Print the results, with the time ratio to a baseline run if one is given.
+
+    :param records: List of result records
+    :param baseline: Records of an earlier run
+    """
+
+    previous = {}
+    if baseline is not None:
+        previous = {(r['benchmark'], r['nteams'], r['seasons']): r['seconds'] for r in baseline}
+
+    print('%-24s %6s %7s %8s %12s %10s %10s %8s' % ('benchmark', 'teams', 'seasons', 'rows', 'ms', 'peak KiB',
+                                                  'error', 'vs base'))
+
+    for r in records:
+        base = previous.get((r['benchmark'], r['nteams'], r['seasons']))
+        print('%-24s %6d %7d %8d %12.3f %10.1f %10s %8s' % (
+            r['benchmark'], r['nteams'], r['seasons'], r['rows'], r['seconds'] * 1000, r['peak_bytes'] / 1024,
+            '-' if r['error'] is None else '%.2e' % r['error'],
+            '-' if base is None else '%.2fx' % (base / r['seconds'])))
+
+
+def compare(baseline, current):
+    """
+    Print a saved run against an earlier one.
+
+    :param baseline: Path of the earlier results
+    :param current: Path of the newer results
+    """
+
+    with open(baseline) as f:
+        old = json.load(f)['results']
+    with open(current) as f:
+        new = json.load(f)['results']
+
+    report(new, old)
+
+
+if __name__ == '__main__':
+    run()
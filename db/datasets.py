@@ -1,36 +1,71 @@
 """ Mongo Aggregations into Pandas DataFrames. """
 
 import pandas as pd
-import numpy as np
-from db import mongo
+import instrumentation
+from db import mongo, process_utils, snapshot
 from scipy.stats import beta
 
-def game_results(season=None, teams=None, date=None):
+def game_results(season=None, teams=None, date=None, use_snapshot=True):
     """
     Creates a Pandas DataFrame that contains game results.
 
     Args:
         season: A list of season numbers
         teams: Team Names, if it's not None the DataFrame will contain indices
+        date: Only games before this date are returned
+        use_snapshot: Read from the local snapshot (refreshed from Mongo when needed) if True
 
     Returns:
         A Pandas DataFrame containing a historical NBA results.
 
     """
 
+    if isinstance(season, int):
+        season = [season]
+
+    with instrumentation.stage('datasets.game_results'):
+        if use_snapshot:
+            games_df = snapshot.load('game_results', season, lambda since: _query_game_results(season, since=since),
+                                     date=date)
+
+            if date is not None and not games_df.empty:
+                games_df = games_df[games_df['date'] < date].reset_index(drop=True)
+        else:
+            games_df = _query_game_results(season, date=date)
+
+        # If team names are included, replace index numbers
+        if teams is not None:
+            games_df['home_team'] = process_utils.team_index(games_df['home_team'], teams)
+            games_df['away_team'] = process_utils.team_index(games_df['away_team'], teams)
+
+    instrumentation.count('datasets.game_results', 'rows', len(games_df))
+
+    return games_df
+
+
+def _query_game_results(season=None, date=None, since=None):
+    """
+    Aggregate game results from Mongo.
+
+    Args:
+        season: A list of season numbers
+        date: Only games before this date are returned
+        since: Only games on or after this date are returned
+
+    Returns:
+        A Pandas DataFrame containing a historical NBA results.
+    """
+
     mongo_wrapper = mongo.Mongo()
 
     season_match = {}
 
     # Match the right season
     if season is not None:
-        if isinstance(season, int):
-            season = [season]
         season_match['season'] = {'$in': season}
 
-    date_match = {}
-    if date is not None:
-        date_match['date'] = {'$lt': date}
+    # Match on season and date first so the index can be used
+    season_match.update(_date_match(date, since))
 
     pipeline = [
         {'$match': season_match},
@@ -41,30 +76,38 @@ def game_results(season=None, teams=None, date=None):
             'away_pts': '$away.pts',
             'season': 1,
             'date': 1
-        }},
-        {'$match': date_match}
-
+        }}
     ]
     # Could aggregate
-    cursor = mongo_wrapper.aggregate(mongo_wrapper.GAME_LOG, pipeline)
+    with instrumentation.stage('datasets.query_game_results'):
+        cursor = mongo_wrapper.aggregate(mongo_wrapper.GAME_LOG, pipeline)
+        df = pd.DataFrame(list(cursor))
 
-    games_df = pd.DataFrame(list(cursor))
+    instrumentation.count('datasets.query_game_results', 'documents', len(df))
 
-    # If team names are included, replace index numbers
-    if teams is not None:
-        home_index = np.zeros(len(games_df), dtype=int)
-        away_index = np.zeros(len(games_df), dtype=int)
+    return df
 
-        # Iterate through each game
-        for row in games_df.itertuples():
-            # Team indexes
-            home_index[row.Index] = teams.index(row.home_team)
-            away_index[row.Index] = teams.index(row.away_team)
 
-        games_df['home_team'] = pd.Series(home_index, index=games_df.index)
-        games_df['away_team'] = pd.Series(away_index, index=games_df.index)
+def _date_match(date=None, since=None):
+    """
+    Mongo $match on the game date.
 
-    return games_df
+    Args:
+        date: Match dates before this date
+        since: Match dates on or after this date
+    """
+
+    date_match = {}
+
+    if date is not None:
+        date_match['$lt'] = date
+    if since is not None:
+        date_match['$gte'] = since
+
+    if date_match:
+        return {'date': date_match}
+
+    return {}
 
 
 def betting_df(season=None, sportsbooks=None):
@@ -126,9 +169,12 @@ def player_abilities(decay, day_span):
     }
 
     mongo_wrapper = mongo.Mongo()
-    cursor = mongo_wrapper.find(mongo_wrapper.PLAYERS_BETA, query, projection)
 
-    abilities_df = pd.DataFrame(list(cursor))
+    with instrumentation.stage('datasets.player_abilities'):
+        cursor = mongo_wrapper.find(mongo_wrapper.PLAYERS_BETA, query, projection)
+        abilities_df = pd.DataFrame(list(cursor))
+
+    instrumentation.count('datasets.player_abilities', 'documents', len(abilities_df))
 
     df = pd.concat([abilities_df.drop(['player'], axis=1), abilities_df['player'].apply(pd.Series)], axis = 1)
 
@@ -166,11 +212,15 @@ def team_abilities(decay, att_constraint, def_constraint, day_span):
     }
 
     mongo_wrapper = mongo.Mongo()
-    cursor = mongo_wrapper.find(mongo_wrapper.DIXON_TEAM, query, projection)
 
-    # The attack and defence columns are dicts, so need to expand them and then
-    # melt so that each row is a team/week
-    abilities_df = pd.DataFrame(list(cursor))
+    with instrumentation.stage('datasets.team_abilities'):
+        cursor = mongo_wrapper.find(mongo_wrapper.DIXON_TEAM, query, projection)
+
+        # The attack and defence columns are dicts, so need to expand them and then
+        # melt so that each row is a team/week
+        abilities_df = pd.DataFrame(list(cursor))
+
+    instrumentation.count('datasets.team_abilities', 'documents', len(abilities_df))
 
     attack = pd.DataFrame(abilities_df.att.values.tolist())
     attack['date'] = abilities_df['date']
@@ -189,7 +239,162 @@ def team_abilities(decay, att_constraint, def_constraint, day_span):
 
     return abilities_df
 
-def player_results(season=None, date = None):
+def previous_team_abilities(decay, att_constraint, def_constraint, day_span, date):
+    """
+    The most recent stored team abilities before a date
+
+    Args:
+        decay: Time decay parameter
+        att_constraint: Mean Attack Constraint of the model
+        def_constraint: Mean Defence Constraint of the model
+        day_span: Number of days in each time decay period
+        date: Abilities must be from before this date
+
+    Returns:
+        The abilities document, or None if nothing has been trained before the date
+    """
+
+    query = {
+        'mw': decay,
+        'att_constraint': att_constraint,
+        'def_constraint': def_constraint,
+        'day_span': day_span,
+        'date': {'$lt': date}
+    }
+
+    mongo_wrapper = mongo.Mongo()
+
+    return mongo_wrapper.find_one(mongo_wrapper.DIXON_TEAM, query, {'att': 1, 'def': 1, 'home_adv': 1},
+                                  sort=[('date', -1)])
+
+def untrained_team_dates(decay, att_constraint, def_constraint, day_span, season=None):
+    """
+    Game dates without stored team abilities
+
+    Args:
+        decay: Time decay parameter
+        att_constraint: Mean Attack Constraint of the model
+        def_constraint: Mean Defence Constraint of the model
+        day_span: Number of days in each time decay period
+        season: A list of season numbers
+
+    Returns:
+        Sorted list of dates
+    """
+
+    query = {
+        'mw': decay,
+        'att_constraint': att_constraint,
+        'def_constraint': def_constraint,
+        'day_span': day_span
+    }
+
+    return _untrained_dates(mongo.Mongo.DIXON_TEAM, query, season)
+
+
+def untrained_player_dates(decay, day_span, season=None):
+    """
+    Game dates without stored player abilities
+
+    Args:
+        decay: Time decay parameter
+        day_span: Number of days in each time decay period
+        season: A list of season numbers
+
+    Returns:
+        Sorted list of dates
+    """
+
+    return _untrained_dates(mongo.Mongo.PLAYERS_BETA, {'mw': decay, 'day_span': day_span}, season)
+
+
+def _untrained_dates(collection, query, season=None):
+    """
+    Distinct game dates that are not distinct dates of an abilities collection
+
+    Args:
+        collection: Abilities collection
+        query: Model configuration of the abilities
+        season: A list of season numbers
+
+    Returns:
+        Sorted list of dates
+    """
+
+    mongo_wrapper = mongo.Mongo()
+
+    season_match = {}
+
+    if season is not None:
+        if isinstance(season, int):
+            season = [season]
+        season_match['season'] = {'$in': season}
+
+    trained = set(mongo_wrapper.distinct(collection, 'date', query))
+    games = set(mongo_wrapper.distinct(mongo_wrapper.GAME_LOG, 'date', season_match))
+
+    return sorted(games - trained)
+
+
+def game_ids(dates):
+    """
+    Ids of the games played on some dates
+
+    Args:
+        dates: List of dates
+
+    Returns:
+        List of game ids
+    """
+
+    mongo_wrapper = mongo.Mongo()
+
+    return [game['_id'] for game in mongo_wrapper.find(mongo_wrapper.GAME_LOG, {'date': {'$in': list(dates)}}, {'_id': 1})]
+
+
+def player_results(season=None, date = None, use_snapshot=True):
+    """
+    Creates a Pandas DataFrame with the points of every player in every game.
+
+    Args:
+        season: A list of season numbers
+        date: Only games before this date are returned
+        use_snapshot: Read from the local snapshot (refreshed from Mongo when needed) if True
+
+    Returns:
+        A Pandas DataFrame of player results
+    """
+
+    if isinstance(season, int):
+        season = [season]
+
+    with instrumentation.stage('datasets.player_results'):
+        if not use_snapshot:
+            df = _query_player_results(season, date=date)
+        else:
+            df = snapshot.load('player_results', season, lambda since: _query_player_results(season, since=since),
+                               date=date)
+
+            if date is not None and not df.empty:
+                df = df[df['date'] < date]
+
+    instrumentation.count('datasets.player_results', 'rows', len(df))
+
+    return df
+
+
+def _query_player_results(season=None, date=None, since=None):
+    """
+    Aggregate player results from Mongo.
+
+    Args:
+        season: A list of season numbers
+        date: Only games before this date are returned
+        since: Only games on or after this date are returned
+
+    Returns:
+        A Pandas DataFrame of player results
+    """
 
     # MongoDB
     m = mongo.Mongo()
@@ -198,20 +403,16 @@ def player_results(season=None, date = None):
 
     # Match the right season
     if season is not None:
-        if isinstance(season, int):
-            season = [season]
         season_match['season'] = {'$in': season}
 
-    date_match = {}
-    if date is not None:
-        date_match['date'] = {'$lt': date}
+    # Match on season and date first so the index can be used
+    season_match.update(_date_match(date, since))
 
     df = None
 
     for i in [['$hplayers.player', '$hplayers.pts', '$home.team', '$home.pts'], ['$aplayers.player', '$aplayers.pts', '$away.team', '$away.pts']]:
         pipeline = [
             {'$match': season_match},
-            {'$match': date_match},
             {'$project': {
                 'player': i[0],
                 'pts': i[1],
@@ -242,11 +443,14 @@ def player_results(season=None, date = None):
             {'$match': {'compare': 0}}
         ]
 
-        games = m.aggregate('game_log', pipeline)
+        with instrumentation.stage('datasets.query_player_results'):
+            games = m.aggregate('game_log', pipeline)
 
-        if df is None:
-            df = pd.DataFrame(list(games))
-        else:
-            df = pd.concat([df, pd.DataFrame(list(games))])
+            if df is None:
+                df = pd.DataFrame(list(games))
+            else:
+                df = pd.concat([df, pd.DataFrame(list(games))])
+
+    instrumentation.count('datasets.query_player_results', 'documents', len(df))
 
     return df
@@ -0,0 +1,154 @@
+""" Game and player results held in memory, sorted by date, so training windows are slices. """
+
+import numpy as np
+import pandas as pd
+from db import datasets
+
+# Columns of datasets.player_results
+PLAYER_COLUMNS = ['date', 'season', 'team', 'player', 'pts', 'team_pts']
+
+
+class History:
+    """
+    Results loaded once and sorted by date.
+
+    The training window of a date is every result in the years before it, which is a contiguous run of the
+    sorted rows, so it is found with two binary searches and returned as a slice instead of a filtered copy.
+    """
+
+    def __init__(self, games, players=None, season=None):
+        """
+        :param games: DataFrame of game results (datasets.game_results)
+        :param players: DataFrame of player results (datasets.player_results), True to read them from the
+                        datasets when they are first used or None for a history without player results
+        :param season: A list of season numbers, the seasons of the player results read from the datasets
+        """
+
+        self.games = self._sort(games)
+        self.game_dates = self.games['date'].values
+
+        self.season = season
+
+        self._players = None
+        self._player_dates = None
+        self._load_players = players is True
+
+        if players is not None and players is not True:
+            self._set_players(players)
+
+    def _set_players(self, players):
+        """ Sort the player results and make them usable by the beta distributions. """
+
+        # Seasons without box scores yet give a frame without any columns
+        if players.empty:
+            players = pd.DataFrame(columns=PLAYER_COLUMNS).astype({'date': 'datetime64[ns]', 'pts': float})
+
+        players = self._sort(players)
+
+        # Beta distributions are not defined at zero
+        players['pts'] = players['pts'].where(players['pts'] != 0, 0.001)
+
+        self._players = players
+        self._player_dates = players['date'].values
+        self._load_players = False
+
+    @property
+    def players(self):
+        """ Player results, read from the datasets on first use if the history was loaded with them. """
+
+        if self._load_players:
+            self._set_players(datasets.player_results(self.season))
+
+        return self._players
+
+    @property
+    def player_dates(self):
+        return None if self.players is None else self._player_dates
+
+    @classmethod
+    def load(cls, season=None, teams=None, players=True):
+        """
+        Read the history from the datasets.
+
+        :param season: A list of season numbers
+        :param teams: Team names, the game results will contain their indices
+        :param players: Read the player results as well, when they are first used, if True
+        :return: History
+        """
+
+        games = datasets.game_results(season, teams=teams)
+
+        return cls(games, True if players else None, season)
+
+    @staticmethod
+    def _sort(df):
+        """ Stable sort on date with a fresh index. """
+
+        if df.empty:
+            return df.reset_index(drop=True)
+
+        return df.sort_values('date', kind='mergesort').reset_index(drop=True)
+
+    @staticmethod
+    def _bounds(dates, date, years_to_keep):
+        """
+        Positions of the rows less than years_to_keep * 365 days before the date.
+
+        :param dates: Sorted datetime64 array
+        :param date: Rows are before this date
+        :param years_to_keep: Length of the window in years
+        :return: Start and end positions
+        """
+
+        date = pd.Timestamp(date)
+
+        start = np.searchsorted(dates, np.datetime64(date - pd.Timedelta(days=365 * years_to_keep)), side='right')
+        end = np.searchsorted(dates, np.datetime64(date), side='left')
+
+        return start, end
+
+    def game_window(self, date, years_to_keep=2):
+        """
+        Games in the years before a date.
+
+        :param date: Games are before this date
+        :param years_to_keep: Length of the window in years
+        :return: Slice of the game results
+        """
+
+        start, end = self._bounds(self.game_dates, date, years_to_keep)
+
+        return self.games.iloc[start:end]
+
+    def player_window(self, date, years_to_keep=2):
+        """
+        Player results in the years before a date.
+
+        :param date: Games are before this date
+        :param years_to_keep: Length of the window in years
+        :return: Slice of the player results
+        """
+
+        players = self.players
+
+        if players is None:
+            raise ValueError('The history was loaded without player results')
+
+        start, end = self._bounds(self._player_dates, date, years_to_keep)
+
+        return players.iloc[start:end]
+
+    def dates(self, season=None):
+        """
+        Distinct game dates.
+
+        :param season: A list of season numbers, None for every season
+        :return: List of Timestamps
+        """
+
+        games = self.games
+
+        if season is not None:
+            games = games[games['season'].isin(season)]
+
+        return [pd.Timestamp(date) for date in games['date'].unique()]
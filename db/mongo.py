@@ -1,5 +1,73 @@
-from pymongo import MongoClient
+import atexit
+import datetime
+import os
+from pymongo import MongoClient, InsertOne, UpdateOne, ASCENDING
 from pymongo import errors
+import instrumentation
+
+# One client (and connection pool) is shared by every Mongo wrapper in a process
+_client = None
+_client_pid = None
+_indexes_pid = None
+_max_pool_size = int(os.environ.get('NBA_MONGO_POOL_SIZE', 100))
+
+# Number of operations sent to the server in each bulk write
+BATCH_SIZE = 1000
+
+# Server error code for a duplicate _id or unique index value
+DUPLICATE_KEY = 11000
+
+
+def configure(max_pool_size):
+    """
+    Set the connection pool size of the shared client.  An existing client is closed and will be
+    recreated with the new size on next use.
+
+    :param max_pool_size: Maximum number of connections in the pool
+    """
+
+    global _max_pool_size
+
+    _max_pool_size = max_pool_size
+    close()
+
+
+def get_client():
+    """
+    The process wide MongoClient, created on first use.
+
+    A client inherited from a parent process is not fork safe, so worker processes get a new one.
+
+    :return: MongoClient
+    """
+
+    global _client, _client_pid
+
+    if _client is None or _client_pid != os.getpid():
+        _client = MongoClient(maxPoolSize=_max_pool_size, connect=False)
+        _client_pid = os.getpid()
+
+    return _client
+
+
+def close():
+    """ Close the shared client, the next Mongo wrapper will open a new one. """
+
+    global _client, _client_pid, _indexes_pid
+
+    # Only the process that created the client owns its sockets
+    if _client is not None and _client_pid == os.getpid():
+        _client.close()
+
+    _client = None
+    _client_pid = None
+
+    # Indexes are checked again with the next client
+    _indexes_pid = None
+
+
+atexit.register(close)
+
 
 class Mongo:
     """
@@ -10,20 +78,145 @@ class Mongo:
     GAME_LOG = 'game_log'
     PLAYERS_BETA = 'player_beta'
 
+    # Indexes needed by each query pattern, equality fields first and the date range last
+    INDEXES = {
+        DIXON_TEAM: [
+            [('mw', ASCENDING), ('att_constraint', ASCENDING), ('def_constraint', ASCENDING),
+             ('day_span', ASCENDING), ('date', ASCENDING)]
+        ],
+        PLAYERS_BETA: [
+            [('mw', ASCENDING), ('day_span', ASCENDING), ('date', ASCENDING)]
+        ],
+        GAME_LOG: [
+            [('season', ASCENDING), ('date', ASCENDING)],
+            [('date', ASCENDING), ('home.team', ASCENDING), ('away.team', ASCENDING)]
+        ]
+    }
+
+    # Example of each query the code runs, used to check they are index backed
+    QUERY_PATTERNS = [
+        (DIXON_TEAM, {'mw': 0.0, 'att_constraint': 0, 'def_constraint': 0, 'day_span': 7}),
+        (DIXON_TEAM, {'mw': 0.0, 'att_constraint': 0, 'def_constraint': 0, 'day_span': 7, 'date': datetime.datetime(2019, 1, 1)}),
+        (PLAYERS_BETA, {'mw': 0.0, 'day_span': 7}),
+        (PLAYERS_BETA, {'mw': 0.0, 'day_span': 7, 'date': datetime.datetime(2019, 1, 1)}),
+        (GAME_LOG, {'season': {'$in': [2019]}}),
+        (GAME_LOG, {'season': {'$in': [2019]}, 'date': {'$lt': datetime.datetime(2019, 1, 1)}}),
+        (GAME_LOG, {'date': {'$lt': datetime.datetime(2019, 1, 1)}}),
+        (GAME_LOG, {'date': datetime.datetime(2019, 1, 1), 'home.team': 'TOR', 'away.team': 'BOS'})
+    ]
+
     def __init__(self):
-        self.client = MongoClient()
+        self.client = get_client()
         self.database = self.client.basketball
 
+        # Indexes only need to be checked once per process
+        global _indexes_pid
+        if _indexes_pid != os.getpid():
+            self.ensure_indexes()
+            _indexes_pid = os.getpid()
+
+    def ensure_indexes(self):
+        """ Create any missing indexes, existing indexes are left alone. """
+
+        for collection, indexes in self.INDEXES.items():
+            for keys in indexes:
+                self.database[collection].create_index(keys)
+
+    def explain(self, collection, query):
+        """
+        Query plan chosen by the server
+
+        :param collection: Collection name
+        :param query: Find query
+        :return: The winning plan
+        """
+
+        return self.database[collection].find(query).explain()['queryPlanner']['winningPlan']
+
+    def index_report(self):
+        """
+        Check each query pattern uses an index
+
+        :return: List of (collection, query, index backed) tuples
+        """
+
+        report = []
+
+        for collection, query in self.QUERY_PATTERNS:
+            report.append((collection, query, 'COLLSCAN' not in str(self.explain(collection, query))))
+
+        return report
+
     def insert(self, collection, doc):
 
-        try:
-            self.database[collection].insert(doc)
-        except errors.DuplicateKeyError:
-            pass
+        with instrumentation.stage('mongo.insert'):
+            try:
+                self.database[collection].insert(doc)
+            except errors.DuplicateKeyError:
+                pass
+
+        instrumentation.count('mongo.insert', 'documents')
+
+    def insert_many(self, collection, docs, batch_size=BATCH_SIZE):
+        """
+        Insert documents in unordered batches.  As with insert, documents that already exist are skipped.
+
+        :param collection: Collection name
+        :param docs: Iterable of documents
+        :param batch_size: Number of documents sent in each batch
+        :return: Number of documents inserted
+        """
+
+        return self.bulk_write(collection, [InsertOne(doc) for doc in docs], batch_size)
+
+    def bulk_write(self, collection, requests, batch_size=BATCH_SIZE):
+        """
+        Send pymongo write operations (InsertOne, UpdateOne, ...) in unordered batches.
+
+        Duplicate key errors are ignored like in insert, any other write error is raised.
+
+        :param collection: Collection name
+        :param requests: List of pymongo write operations
+        :param batch_size: Number of operations sent in each batch
+        :return: Number of documents inserted, matched or upserted
+        """
+
+        written = 0
+
+        for start in range(0, len(requests), batch_size):
+            with instrumentation.stage('mongo.bulk_write'):
+                try:
+                    result = self.database[collection].bulk_write(requests[start:start + batch_size], ordered=False)
+                    details = result.bulk_api_result
+                except errors.BulkWriteError as bwe:
+                    details = bwe.details
+                    if details['writeConcernErrors'] or \
+                            any(error['code'] != DUPLICATE_KEY for error in details['writeErrors']):
+                        raise
+
+            written += details['nInserted'] + details['nMatched'] + details['nUpserted']
+
+        instrumentation.count('mongo.bulk_write', 'operations', len(requests))
+        instrumentation.count('mongo.bulk_write', 'documents', written)
+
+        return written
+
+    def bulk(self, collection, batch_size=BATCH_SIZE):
+        """
+        Buffered writer that flushes every batch_size operations, use it as a context manager so the
+        remaining operations are flushed at the end.
+
+        :param collection: Collection name
+        :param batch_size: Number of operations sent in each batch
+        :return: BulkWriter
+        """
+
+        return BulkWriter(self, collection, batch_size)
 
     def count(self, collection, criteria=None):
 
-        return self.database[collection].count(criteria)
+        with instrumentation.stage('mongo.count'):
+            return self.database[collection].count(criteria)
 
     def find(self, collection, query=None, projection=None):
 
@@ -32,11 +225,22 @@ class Mongo:
 
         return self.database[collection].find(query)
 
-    def find_one(self, collection, query=None, projection=None):
-        if projection:
-            return self.database[collection].find_one(query, projection)
+    def distinct(self, collection, key, query=None):
+
+        with instrumentation.stage('mongo.distinct'):
+            values = self.database[collection].distinct(key, query)
+
+        instrumentation.count('mongo.distinct', 'values', len(values))
 
-        return self.database[collection].find_one(query)
+        return values
+
+    def find_one(self, collection, query=None, projection=None, sort=None):
+
+        with instrumentation.stage('mongo.find_one'):
+            if projection:
+                return self.database[collection].find_one(query, projection, sort=sort)
+
+            return self.database[collection].find_one(query, sort=sort)
 
     def update(self, collection, query, update):
 
@@ -50,11 +254,49 @@ class Mongo:
 
         """
 
-        return self.database[collection].aggregate(pipeline, allowDiskUse=True)
+        # The first batch is returned with the cursor, the rest are read by the caller
+        with instrumentation.stage('mongo.aggregate'):
+            return self.database[collection].aggregate(pipeline, allowDiskUse=True)
 
     def remove(self, collection, query=None):
 
-        return self.database[collection].remove(query)
+        with instrumentation.stage('mongo.remove'):
+            return self.database[collection].remove(query)
+
+
+class BulkWriter:
+    """
+    Collects inserts and updates for one collection and sends them with Mongo.bulk_write.
+    """
+
+    def __init__(self, mongo_wrapper, collection, batch_size=BATCH_SIZE):
+        self.mongo = mongo_wrapper
+        self.collection = collection
+        self.batch_size = batch_size
+        self.requests = []
+        self.written = 0
+
+    def insert(self, doc):
+        self._add(InsertOne(doc))
+
+    def update(self, query, update, upsert=False):
+        self._add(UpdateOne(query, update, upsert=upsert))
+
+    def _add(self, request):
+        self.requests.append(request)
+
+        if len(self.requests) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Send the buffered operations. """
+
+        if self.requests:
+            self.written += self.mongo.bulk_write(self.collection, self.requests, self.batch_size)
+            self.requests = []
+
+    def __enter__(self):
+        return self
 
-    def __del__(self):
-        self.client.close()
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
@@ -1,4 +1,6 @@
 import string
+import numpy as np
+import pandas as pd
 from db import mongo
 
 teams = ['ATL', 'BOS', 'BRK', 'CHO', 'CHI', 'CLE', 'DAL', 'DEN', 'DET', 'GSW', 'HOU', 'IND', 'LAC', 'LAL', 'MEM',
@@ -55,3 +57,23 @@ def name_teams(test, nteams=None):
                 team_names.append(string.ascii_uppercase[i - 26] + string.ascii_uppercase[i - 26])
 
         return team_names
+
+
+def team_index(names, teams):
+    """
+    Encode team names as their integer index in a list of teams.
+
+    :param names: Team names (list, array or Series)
+    :param teams: Team names in index order
+    :return: Numpy array of team indices
+    :raise ValueError: If a name is not in teams
+    """
+
+    codes = pd.Categorical(names, categories=teams).codes
+
+    # Names that are not categories are coded as -1
+    unknown = codes == -1
+    if unknown.any():
+        raise ValueError('Unknown team codes: %s' % ', '.join(sorted(set(map(str, np.asarray(names)[unknown])))))
+
+    return codes.astype(int)
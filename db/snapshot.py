@@ -0,0 +1,126 @@
+""" Local columnar snapshots of the game_log aggregations, refreshed incrementally from Mongo. """
+
+import os
+import pandas as pd
+
+# Snapshots are kept out of the repository, the location can be changed with NBA_SNAPSHOT_DIR
+SNAPSHOT_DIR = os.environ.get('NBA_SNAPSHOT_DIR',
+                              os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'snapshots'))
+
+
+def snapshot_path(name, season=None):
+    """
+    File of a snapshot
+
+    :param name: Name of the dataset (ex. game_results)
+    :param season: List of seasons in the snapshot, None for every season
+    :return: Path to the parquet file
+    """
+
+    if season is None:
+        key = 'all'
+    else:
+        key = '_'.join(str(year) for year in sorted(season))
+
+    return os.path.join(SNAPSHOT_DIR, '%s_%s.parquet' % (name, key))
+
+
+def load(name, season, fetch, date=None):
+    """
+    Load a snapshot, pulling anything newer than its high-water mark from Mongo first.
+
+    The high-water mark is the latest game date in the snapshot.  Games on that date are fetched again
+    because the day may not have been complete when it was stored.
+
+    :param name: Name of the dataset (ex. game_results)
+    :param season: List of seasons in the snapshot, None for every season
+    :param fetch: Function of a date that returns the DataFrame of rows on or after it (None for all rows)
+    :param date: Rows will only be used before this date, so no refresh is needed if it is not past the high-water mark
+    :return: DataFrame of every row in the snapshot
+    """
+
+    path = snapshot_path(name, season)
+
+    if not os.path.exists(path):
+        df = fetch(None)
+        save(df, path)
+        return df
+
+    df = pd.read_parquet(path)
+    high_water_mark = df['date'].max()
+
+    if date is not None and date <= high_water_mark:
+        return df
+
+    new = fetch(high_water_mark)
+
+    if new.empty:
+        return df
+
+    df = pd.concat([df[df['date'] < high_water_mark], new], ignore_index=True, sort=False)
+    save(df, path)
+
+    return df
+
+
+def save(df, path):
+    """
+    Write a snapshot, replacing the old file atomically so concurrent readers never see a partial file
+
+    :param df: DataFrame to store
+    :param path: Path to the parquet file
+    """
+
+    if df.empty:
+        return
+
+    if not os.path.exists(SNAPSHOT_DIR):
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    df.reset_index(drop=True).to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def invalidate(name, since):
+    """
+    Drop the rows on or after a date from every snapshot of a dataset, so the next load fetches them again.
+
+    Needed when documents older than the high-water mark change in Mongo, ex. box scores scraped late.
+
+    :param name: Name of the dataset (ex. player_results)
+    :param since: Earliest date that changed
+    """
+
+    if not os.path.exists(SNAPSHOT_DIR):
+        return
+
+    since = pd.Timestamp(since)
+
+    for file_name in os.listdir(SNAPSHOT_DIR):
+        if not (file_name.startswith(name + '_') and file_name.endswith('.parquet')):
+            continue
+
+        path = os.path.join(SNAPSHOT_DIR, file_name)
+        df = pd.read_parquet(path)
+        kept = df[df['date'] < since]
+
+        if len(kept) == len(df):
+            continue
+
+        # Nothing left to refresh from, so the snapshot is rebuilt
+        if kept.empty:
+            os.remove(path)
+        else:
+            save(kept, path)
+
+
+def clear():
+    """ Delete every snapshot so the next load rebuilds them from Mongo. """
+
+    if not os.path.exists(SNAPSHOT_DIR):
+        return
+
+    for file_name in os.listdir(SNAPSHOT_DIR):
+        if file_name.endswith('.parquet'):
+            os.remove(os.path.join(SNAPSHOT_DIR, file_name))
@@ -0,0 +1,188 @@
+""" Wall time and counters of each stage of the model, switched on with enable() or NBA_INSTRUMENT=1. """
+
+import collections
+import json
+import os
+import threading
+import time
+
+_enabled = os.environ.get('NBA_INSTRUMENT', '').lower() in ('1', 'true', 'yes')
+
+# Stage name -> Stage, in the order stages were first seen
+_stages = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+class Stage:
+    """ Totals of one stage. """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.counters = collections.OrderedDict()
+
+    def to_dict(self):
+        return collections.OrderedDict([('stage', self.name),
+                                        ('calls', self.calls),
+                                        ('seconds', self.seconds),
+                                        ('counters', dict(self.counters))])
+
+
+class _Timer:
+    """ Context manager adding its wall time to a stage. """
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+
+        with _lock:
+            stage = _get(self.name)
+            stage.calls += 1
+            stage.seconds += seconds
+
+        return False
+
+
+class _NullTimer:
+    """ Context manager that does nothing, used when instrumentation is off. """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def _get(name):
+    """ The stage with a name, created if needed.  The lock must be held. """
+
+    stage = _stages.get(name)
+
+    if stage is None:
+        stage = _stages[name] = Stage(name)
+
+    return stage
+
+
+def enable(enabled=True):
+    """ Turn instrumentation on or off, recorded totals are kept. """
+
+    global _enabled
+    _enabled = enabled
+
+
+def enabled():
+    return _enabled
+
+
+def reset():
+    """ Forget every recorded stage. """
+
+    with _lock:
+        _stages.clear()
+
+
+def stage(name):
+    """
+    Time a block of code.
+
+        with instrumentation.stage('train.optimize'):
+            ...
+
+    :param name: Stage name, dotted by component (ex. mongo.aggregate)
+    :return: Context manager
+    """
+
+    if not _enabled:
+        return _NULL_TIMER
+
+    return _Timer(name)
+
+
+def count(name, counter, n=1):
+    """
+    Add to a counter of a stage.
+
+    :param name: Stage name
+    :param counter: Counter name (ex. rows, documents)
+    :param n: Amount to add
+    """
+
+    if not _enabled:
+        return
+
+    with _lock:
+        counters = _get(name).counters
+        counters[counter] = counters.get(counter, 0) + n
+
+
+def optimizer(name, opt):
+    """
+    Count the iterations and function evaluations of a scipy OptimizeResult.
+
+    :param name: Stage name
+    :param opt: OptimizeResult
+    """
+
+    if not _enabled:
+        return
+
+    count(name, 'nit', int(getattr(opt, 'nit', 0)))
+    count(name, 'nfev', int(getattr(opt, 'nfev', 0)))
+
+
+def stages():
+    """ Snapshot of every stage as a list of dicts. """
+
+    with _lock:
+        return [stage.to_dict() for stage in _stages.values()]
+
+
+def report():
+    """
+    Summary table of every stage.
+
+    :return: String table
+    """
+
+    lines = ['%-36s %8s %12s %12s  %s' % ('stage', 'calls', 'seconds', 'mean ms', 'counters')]
+
+    for stage in stages():
+        mean = stage['seconds'] / stage['calls'] * 1000 if stage['calls'] else 0.0
+        counters = ', '.join('%s=%s' % (key, value) for key, value in stage['counters'].items())
+
+        lines.append('%-36s %8d %12.3f %12.3f  %s' % (stage['stage'], stage['calls'], stage['seconds'], mean,
+                                                       counters))
+
+    return '\n'.join(lines)
+
+
+def to_json(path=None):
+    """
+    Every stage as JSON.
+
+    :param path: File to write, the JSON is only returned if None
+    :return: JSON string
+    """
+
+    content = json.dumps({'pid': os.getpid(), 'stages': stages()}, indent=2)
+
+    if path is not None:
+        with open(path, 'w') as f:
+            f.write(content)
+
+    return content
@@ -1,10 +1,29 @@
 """ This module contains functions to model basketball teams. """
 
 import numpy as np
+from scipy.optimize import minimize
+from scipy.special import betaln, gammaln, polygamma, psi
 from scipy.stats import poisson
 from scipy.stats import beta
 
 
+def decay_weights(games, date, day_span, decay):
+    """
+    Time decay weight of each game relative to a date.
+
+    Args:
+        games: DataFrame of historical results with a date column
+        date: Current date of the simulation
+        day_span: Number of days in each time decay period
+        decay: Time decay factor
+
+    Returns:
+        Numpy array of weights, one per game
+    """
+
+    return np.exp(-decay * np.ceil(((date - games['date']).dt.days.values) / day_span))
+
+
 def dixon_coles(params, games, nteams, date, day_span, decay):
     """
     This is the likelihood function for the Dixon Coles model adapted for basketball.
@@ -33,6 +52,56 @@ def dixon_coles(params, games, nteams, date, day_span, decay):
     return -np.dot(likelihood, weight)
 
 
+def dixon_coles_grad(params, games, nteams, date, day_span, decay):
+    """
+    The Dixon Coles likelihood together with its exact gradient, for use with minimize(jac=True).
+
+    Training uses DixonColes.gradient, this is kept as the per-call reference that benchmarks/likelihood.py
+    times it against, so the two must stay in sync.
+
+    Args:
+        params: Dixon-Coles model parameters
+        games: DataFrame of historical results
+        nteams: Number of teams in dataset
+        date: Current date of the simulation
+        day_span: Number of days in each time decay period
+        decay: Time decay factor (Bigger number results in higher weighting for recent matches)
+
+    Returns:
+        Tuple of the Log Likelihood and its gradient with respect to params
+    """
+
+    home = games['home_team'].values
+    away = games['away_team'].values
+    home_pts = games['home_pts'].values
+    away_pts = games['away_pts'].values
+
+    home_att = params[home]
+    away_att = params[away]
+    home_def = params[home + nteams]
+    away_def = params[away + nteams]
+    home_adv = params[home + nteams + nteams]
+
+    hmean = home_att * away_def * home_adv
+    amean = away_att * home_def
+
+    likelihood = poisson.logpmf(home_pts, hmean) + poisson.logpmf(away_pts, amean)
+    weight = np.exp(-decay * np.ceil(((date - games['date']).dt.days.values) / day_span))
+
+    # Derivative of the weighted log likelihood with respect to each mean
+    hgrad = -weight * (home_pts / hmean - 1)
+    agrad = -weight * (away_pts / amean - 1)
+
+    # Chain rule through the products that make up each mean
+    grad = np.bincount(home, hgrad * away_def * home_adv, minlength=nteams * 3) \
+        + np.bincount(away + nteams, hgrad * home_att * home_adv, minlength=nteams * 3) \
+        + np.bincount(home + nteams + nteams, hgrad * home_att * away_def, minlength=nteams * 3) \
+        + np.bincount(away, agrad * home_def, minlength=nteams * 3) \
+        + np.bincount(home + nteams, agrad * away_att, minlength=nteams * 3)
+
+    return -np.dot(likelihood, weight), grad
+
+
 def player_beta(params, games, date, day_span, decay):
     """
     Likelihood function to determine player beta distribution parameters
@@ -43,3 +112,463 @@ def player_beta(params, games, date, day_span, decay):
     weight = np.exp(-decay * np.ceil(((date - games['date']).dt.days) / day_span))
 
     return -np.dot(likelihood, weight)
+
+
+class DixonColes:
+    """
+    Precompiled Dixon Coles likelihood for a fixed set of games.
+
+    The team indices, decay weights, points and log-factorial terms never change while the optimizer
+    runs, so they are computed once here and every call only gathers the parameters into preallocated
+    buffers.
+    """
+
+    def __init__(self, home, away, home_pts, away_pts, weight, nteams):
+        """
+        Args:
+            home: Home team index of each game
+            away: Away team index of each game
+            home_pts: Points scored by the home team
+            away_pts: Points scored by the away team
+            weight: Time decay weight of each game
+            nteams: Number of teams in dataset
+        """
+
+        self.nteams = nteams
+
+        # Parameter indices for each game
+        self.home = np.ascontiguousarray(home, dtype=np.intp)
+        self.away = np.ascontiguousarray(away, dtype=np.intp)
+        self.home_def = self.home + nteams
+        self.away_def = self.away + nteams
+        self.home_adv = self.home + nteams + nteams
+
+        self.weight = np.ascontiguousarray(weight, dtype=float)
+        self.home_pts = np.ascontiguousarray(home_pts, dtype=float)
+        self.away_pts = np.ascontiguousarray(away_pts, dtype=float)
+
+        # Weighted points and the weighted log-factorial constant of the poisson pmf
+        self.weighted_home_pts = self.weight * self.home_pts
+        self.weighted_away_pts = self.weight * self.away_pts
+        self.log_factorial = gammaln(self.home_pts + 1) + gammaln(self.away_pts + 1)
+        self.constant = np.dot(self.weight, self.log_factorial)
+
+        # Scratch buffers reused on every call
+        n = len(self.home)
+        self._home_att = np.empty(n)
+        self._away_att = np.empty(n)
+        self._home_def = np.empty(n)
+        self._away_def = np.empty(n)
+        self._home_adv = np.empty(n)
+        self._hmean = np.empty(n)
+        self._amean = np.empty(n)
+        self._tmp = np.empty(n)
+
+    @classmethod
+    def from_games(cls, games, nteams, date, day_span, decay):
+        """
+        Build the likelihood from a DataFrame of games with team indices.
+
+        Args:
+            games: DataFrame of historical results
+            nteams: Number of teams in dataset
+            date: Current date of the simulation
+            day_span: Number of days in each time decay period
+            decay: Time decay factor (Bigger number results in higher weighting for recent matches)
+        """
+
+        return cls(games['home_team'].values, games['away_team'].values,
+                   games['home_pts'].values, games['away_pts'].values,
+                   decay_weights(games, date, day_span, decay), nteams)
+
+    def _means(self, params):
+        """ Fill the mean buffers for the given parameters. """
+
+        np.take(params, self.home, out=self._home_att)
+        np.take(params, self.away, out=self._away_att)
+        np.take(params, self.home_def, out=self._home_def)
+        np.take(params, self.away_def, out=self._away_def)
+        np.take(params, self.home_adv, out=self._home_adv)
+
+        np.multiply(self._home_att, self._away_def, out=self._hmean)
+        self._hmean *= self._home_adv
+        np.multiply(self._away_att, self._home_def, out=self._amean)
+
+    def _likelihood(self):
+        """ Negative log likelihood of the means currently in the buffers. """
+
+        likelihood = np.dot(self.weight, self._hmean) + np.dot(self.weight, self._amean) + self.constant
+
+        np.log(self._hmean, out=self._tmp)
+        likelihood -= np.dot(self.weighted_home_pts, self._tmp)
+        np.log(self._amean, out=self._tmp)
+        likelihood -= np.dot(self.weighted_away_pts, self._tmp)
+
+        return likelihood
+
+    def __call__(self, params):
+        """
+        Args:
+            params: Dixon-Coles model parameters
+
+        Returns:
+            The Log Likelihood from the Dixon-Coles Model with the passed set of parameters
+        """
+
+        self._means(params)
+
+        return self._likelihood()
+
+    def gradient(self, params):
+        """
+        The likelihood and its exact gradient, for use with minimize(jac=True).
+
+        Args:
+            params: Dixon-Coles model parameters
+
+        Returns:
+            Tuple of the Log Likelihood and its gradient with respect to params
+        """
+
+        self._means(params)
+        likelihood = self._likelihood()
+
+        size = self.nteams * 3
+
+        # Derivative with respect to the home mean, chained through its three factors
+        np.divide(self.weighted_home_pts, self._hmean, out=self._hmean)
+        np.subtract(self.weight, self._hmean, out=self._hmean)
+
+        np.multiply(self._hmean, self._away_def, out=self._tmp)
+        self._tmp *= self._home_adv
+        grad = np.bincount(self.home, self._tmp, minlength=size)
+
+        np.multiply(self._hmean, self._home_att, out=self._tmp)
+        self._tmp *= self._home_adv
+        grad += np.bincount(self.away_def, self._tmp, minlength=size)
+
+        np.multiply(self._hmean, self._home_att, out=self._tmp)
+        self._tmp *= self._away_def
+        grad += np.bincount(self.home_adv, self._tmp, minlength=size)
+
+        # Derivative with respect to the away mean
+        np.divide(self.weighted_away_pts, self._amean, out=self._amean)
+        np.subtract(self.weight, self._amean, out=self._amean)
+
+        np.multiply(self._amean, self._home_def, out=self._tmp)
+        grad += np.bincount(self.away, self._tmp, minlength=size)
+
+        np.multiply(self._amean, self._away_att, out=self._tmp)
+        grad += np.bincount(self.home_def, self._tmp, minlength=size)
+
+        return likelihood, grad
+
+    def compressed(self):
+        """
+        The same likelihood with the games of each (home team, away team) pair combined.
+
+        Both means only depend on the pair, so the likelihood only needs the total weight and the weighted
+        points of each pair plus the constant, and every call costs O(pairs) instead of O(games).
+
+        Returns:
+            DixonColes with one row per pair
+        """
+
+        pairs, inverse = np.unique(self.home * self.nteams + self.away, return_inverse=True)
+
+        return DixonColes.from_pairs(pairs // self.nteams, pairs % self.nteams,
+                                     np.bincount(inverse, self.weight),
+                                     np.bincount(inverse, self.weighted_home_pts),
+                                     np.bincount(inverse, self.weighted_away_pts),
+                                     self.constant, self.nteams)
+
+    @classmethod
+    def from_pairs(cls, home, away, weight, weighted_home_pts, weighted_away_pts, constant, nteams):
+        """
+        Build the likelihood from the weighted sums of each (home team, away team) pair.
+
+        Args:
+            home: Home team index of each pair
+            away: Away team index of each pair
+            weight: Total time decay weight of the pair's games
+            weighted_home_pts: Weighted sum of the home points
+            weighted_away_pts: Weighted sum of the away points
+            constant: Weighted sum of the log-factorial terms of every game
+            nteams: Number of teams in dataset
+        """
+
+        # Pairs whose decay weights all underflowed add nothing to the likelihood, and would divide 0 by 0
+        keep = weight > 0
+        home, away, weight = home[keep], away[keep], weight[keep]
+        weighted_home_pts, weighted_away_pts = weighted_home_pts[keep], weighted_away_pts[keep]
+
+        # Weighted mean points, so weight * points is the weighted sum of the pair
+        likelihood = cls(home, away, weighted_home_pts / weight, weighted_away_pts / weight, weight, nteams)
+
+        # The log-factorials are of the individual games
+        likelihood.log_factorial = None
+        likelihood.constant = constant
+
+        return likelihood
+
+
+class Reparameterization:
+    """
+    Unconstrained coordinates of the Dixon Coles parameters.
+
+    The attack and defence are the softmax of free coordinates scaled so their means are the constraints,
+    and every other ability is the exponential of its coordinate.  Every point satisfies the mean constraints
+    and keeps the abilities positive, so the likelihood can be minimized without constraints.
+    """
+
+    def __init__(self, att_constraint, def_constraint, nteams):
+        """
+        Args:
+            att_constraint: Mean attack, None if the attack is not constrained
+            def_constraint: Mean defence, None if the defence is not constrained
+            nteams: Number of teams in dataset
+        """
+
+        self.nteams = nteams
+        self.blocks = [(slice(0, nteams), att_constraint), (slice(nteams, nteams * 2), def_constraint)]
+
+    def to_params(self, z):
+        """ Dixon Coles parameters of the coordinates. """
+
+        params = np.exp(z)
+
+        for block, constraint in self.blocks:
+            if constraint is not None:
+                # Softmax shifted by the maximum so the exponentials can't overflow
+                params[block] = np.exp(z[block] - z[block].max())
+                params[block] *= constraint * self.nteams / params[block].sum()
+
+        return params
+
+    def from_params(self, params):
+        """ Coordinates of positive Dixon Coles parameters, the inverse of to_params when they meet the constraints. """
+
+        return np.log(np.maximum(params, 1e-10))
+
+    def gradient(self, params, grad):
+        """
+        Chain the gradient with respect to the parameters back to the coordinates.
+
+        Args:
+            params: Dixon Coles parameters, to_params of the coordinates
+            grad: Gradient with respect to params
+        """
+
+        z_grad = params * grad
+
+        for block, constraint in self.blocks:
+            if constraint is not None:
+                # d params_i / d z_j = params_i * (delta_ij - params_j / sum(params))
+                z_grad[block] -= params[block] / params[block].sum() * z_grad[block].sum()
+
+        return z_grad
+
+
+def minimize_unconstrained(gradient, x0, att_constraint, def_constraint, nteams, method='L-BFGS-B'):
+    """
+    Minimize a Dixon Coles likelihood in the coordinates of Reparameterization.
+
+    Args:
+        gradient: Function of the parameters returning the likelihood and its gradient (DixonColes.gradient)
+        x0: Initial Dixon Coles parameters
+        att_constraint: Mean attack, None if the attack is not constrained
+        def_constraint: Mean defence, None if the defence is not constrained
+        nteams: Number of teams in dataset
+        method: scipy.optimize.minimize method that uses gradients (L-BFGS-B, Newton-CG, BFGS)
+
+    Returns:
+        OptimizeResult with x in the Dixon Coles parameters
+    """
+
+    transform = Reparameterization(att_constraint, def_constraint, nteams)
+
+    def objective(z):
+        params = transform.to_params(z)
+        likelihood, grad = gradient(params)
+        return likelihood, transform.gradient(params, grad)
+
+    opt = minimize(objective, x0=transform.from_params(np.asarray(x0, dtype=float)), jac=True, method=method)
+    opt.x = transform.to_params(opt.x)
+
+    return opt
+
+
+class PlayerBeta:
+    """
+    Precompiled player beta likelihood for a fixed set of games.
+
+    The log of each points share and its complement are computed once, so each call reduces to two
+    weighted sums and a log beta function.
+    """
+
+    def __init__(self, share, weight):
+        """
+        Args:
+            share: Player points divided by team points for each game
+            weight: Time decay weight of each game
+        """
+
+        share = np.ascontiguousarray(share, dtype=float)
+
+        self.weight = np.ascontiguousarray(weight, dtype=float)
+        self.total_weight = self.weight.sum()
+        self.log_share = np.dot(self.weight, np.log(share))
+        self.log_rest = np.dot(self.weight, np.log1p(-share))
+
+    @classmethod
+    def from_games(cls, games, date, day_span, decay):
+        """
+        Build the likelihood from a DataFrame of a player's games.
+
+        Args:
+            games: DataFrame with pts, team_pts and date columns
+            date: Current date of the simulation
+            day_span: Number of days in each time decay period
+            decay: Time decay factor
+        """
+
+        return cls((games['pts'] / games['team_pts']).values, decay_weights(games, date, day_span, decay))
+
+    def __call__(self, params):
+        """
+        Args:
+            params: Beta distribution parameters (a, b)
+
+        Returns:
+            Likelihood
+        """
+
+        a, b = params[0], params[1]
+
+        # Same as scipy's logpdf outside of the distribution's support
+        if a <= 0 or b <= 0:
+            return np.nan
+
+        return -((a - 1) * self.log_share + (b - 1) * self.log_rest - self.total_weight * betaln(a, b))
+
+
+def player_beta_stats(share, weight, players, nplayers):
+    """
+    Weighted sufficient statistics of the player beta likelihood, one entry per player.
+
+    Args:
+        share: Player points divided by team points for each game
+        weight: Time decay weight of each game
+        players: Player index of each game
+        nplayers: Number of players
+
+    Returns:
+        Tuple of arrays (total weight, weighted sum of log share, weighted sum of log(1 - share),
+        weighted sum of share, weighted sum of share squared)
+    """
+
+    return (np.bincount(players, weight, minlength=nplayers),
+            np.bincount(players, weight * np.log(share), minlength=nplayers),
+            np.bincount(players, weight * np.log1p(-share), minlength=nplayers),
+            np.bincount(players, weight * share, minlength=nplayers),
+            np.bincount(players, weight * share * share, minlength=nplayers))
+
+
+def fit_player_betas(total_weight, log_share, log_rest, share, share_squared, max_iter=100, tol=1e-10):
+    """
+    Fit every player's beta distribution at once by Newton's method on the sufficient statistics.
+
+    The beta log likelihood is concave in (a, b) and its Hessian does not depend on the data, so the Newton and
+    Fisher scoring updates are the same.  Each fit starts from the weighted method of moments estimate.
+
+    Args:
+        total_weight, log_share, log_rest, share, share_squared: Statistics from player_beta_stats
+        max_iter: Maximum number of Newton updates
+        tol: Relative step size at which a player has converged
+
+    Returns:
+        Arrays of a, b and whether each player's fit converged
+    """
+
+    # Weighted method of moments
+    mean = share / total_weight
+    var = share_squared / total_weight - mean * mean
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        common = mean * (1 - mean) / var - 1
+
+    # The maximum likelihood estimate does not exist without spread in the shares
+    valid = np.isfinite(common) & (common > 0)
+
+    a = np.where(valid, mean * common, 1.0)
+    b = np.where(valid, (1 - mean) * common, 1.0)
+
+    converged = np.zeros(len(a), dtype=bool)
+    active = valid.copy()
+
+    for _ in range(max_iter):
+
+        if not active.any():
+            break
+
+        aa, bb, weight = a[active], b[active], total_weight[active]
+
+        # Gradient of the log likelihood
+        digamma_ab = psi(aa + bb)
+        grad_a = log_share[active] - weight * (psi(aa) - digamma_ab)
+        grad_b = log_rest[active] - weight * (psi(bb) - digamma_ab)
+
+        # Negative Hessian
+        trigamma_ab = polygamma(1, aa + bb)
+        info_aa = weight * (polygamma(1, aa) - trigamma_ab)
+        info_bb = weight * (polygamma(1, bb) - trigamma_ab)
+        info_ab = -weight * trigamma_ab
+
+        det = info_aa * info_bb - info_ab * info_ab
+        step_a = (info_bb * grad_a - info_ab * grad_b) / det
+        step_b = (info_aa * grad_b - info_ab * grad_a) / det
+
+        # Stay inside the support by going at most half way to zero
+        with np.errstate(divide='ignore', invalid='ignore'):
+            limit = np.minimum(np.where(step_a < 0, -0.5 * aa / step_a, np.inf),
+                               np.where(step_b < 0, -0.5 * bb / step_b, np.inf))
+        scale = np.minimum(1.0, limit)
+
+        a[active] = aa + scale * step_a
+        b[active] = bb + scale * step_b
+
+        # Players whose step is small enough are done, those that blow up are left for scipy
+        finished = (np.abs(step_a) <= tol * aa) & (np.abs(step_b) <= tol * bb)
+        failed = ~(np.isfinite(a[active]) & np.isfinite(b[active]))
+
+        index = np.flatnonzero(active)
+        converged[index[finished & ~failed]] = True
+        active[index[finished | failed]] = False
+
+    return a, b, converged
+
+
+def fit_player_beta(share, weight, x0):
+    """
+    Fit one player's beta distribution with scipy, for players the batched fit can not handle.
+
+    Args:
+        share: Player points divided by team points for each game
+        weight: Time decay weight of each game
+        x0: Initial guess of (a, b)
+
+    Returns:
+        Array of (a, b)
+    """
+
+    con = [{'type': 'ineq', 'fun': _first}, {'type': 'ineq', 'fun': _second}]
+
+    return minimize(PlayerBeta(share, weight), x0=x0, constraints=con).x
+
+
+def _first(x):
+    return x[0]
+
+
+def _second(x):
+    return x[1]
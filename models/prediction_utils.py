@@ -23,20 +23,81 @@ def determine_probabilities(hmean, amean):
     :return: Probabilities of home and away team
     """
 
+    hprob, aprob = win_probabilities([hmean], [amean])
+
+    return hprob[0], aprob[0]
+
+
+def win_probabilities(hmean, amean, max_score=200, batch_size=10000):
+    """
+    Determine the probabilities of the home and away teams winning for many games at once
+    :param hmean: Array of home team poisson means
+    :param amean: Array of away team poisson means
+    :param max_score: Scores from 0 up to (not including) this value are considered
+    :param batch_size: Number of games in each pmf matrix, limits memory use
+    :return: Arrays of home and away win probabilities
+    """
+
+    hmean = np.asarray(hmean, dtype=float)
+    amean = np.asarray(amean, dtype=float)
+
     # Possible scores
-    scores = np.arange(0, 200)
+    scores = np.arange(0, max_score)
+
+    hprob = np.empty(len(hmean))
+    aprob = np.empty(len(amean))
+
+    for start in range(0, len(hmean), batch_size):
+        end = start + batch_size
 
-    hprob = np.zeros(len(scores))
-    aprob = np.zeros(len(scores))
+        # Score probabilities, one row per game
+        hpmf = poisson.pmf(scores, hmean[start:end, np.newaxis])
+        apmf = poisson.pmf(scores, amean[start:end, np.newaxis])
 
-    # The probability for the home team is the sum of the poisson probabilities when h > a and
-    # vice versa for the away team
-    for x in scores:
-        hprob[x] = np.sum(poisson.pmf(mu=hmean, k=x) * poisson.pmf(mu=amean, k=np.where(scores < x)))
-        aprob[x] = np.sum(poisson.pmf(mu=amean, k=x) * poisson.pmf(mu=hmean, k=np.where(scores < x)))
+        # Probability of scoring less than each score
+        hless = np.zeros_like(hpmf)
+        aless = np.zeros_like(apmf)
+        np.cumsum(hpmf[:, :-1], axis=1, out=hless[:, 1:])
+        np.cumsum(apmf[:, :-1], axis=1, out=aless[:, 1:])
 
-    # Return sum
-    return np.sum(hprob), np.sum(aprob)
+        # The home team wins when h > a and vice versa for the away team
+        hprob[start:end] = np.sum(hpmf * aless, axis=1)
+        aprob[start:end] = np.sum(apmf * hless, axis=1)
+
+    return hprob, aprob
+
+
+def missing_player_penalty(games, player_abilities, player_results, player_penalty):
+    """
+    Multiplicative penalty on each team's mean when its ranked players did not take part in a game
+    :param games: DataFrame of games with _id, date, home_team and away_team
+    :param player_abilities: Ranked player abilities with team, date, name and mean
+    :param player_results: Player results with the _id and player of every appearance
+    :param player_penalty: Penalty applied per unit of a missing player's mean
+    :return: Arrays of home and away penalties (NaN when a team has no ranked players on the date)
+    """
+
+    # Players who took part in each game
+    played = player_results[['_id', 'player']].drop_duplicates()
+    played['played'] = True
+
+    rows = np.arange(len(games))
+    penalties = []
+
+    for side in ['home_team', 'away_team']:
+
+        # Ranked players of the team on the date of each game
+        ranked = pd.DataFrame({'row': rows,
+                               '_id': games['_id'].astype(str).values,
+                               'team': games[side].values,
+                               'date': games['date'].values})
+        ranked = ranked.merge(player_abilities[['team', 'date', 'name', 'mean']], on=['team', 'date'])
+        ranked = ranked.merge(played, left_on=['_id', 'name'], right_on=['_id', 'player'], how='left')
+
+        penalty = 1 - (ranked['mean'] * ranked['played'].isnull() * player_penalty)
+        penalties.append(penalty.groupby(ranked['row']).prod().reindex(rows).values)
+
+    return penalties[0], penalties[1]
 
 
 def attack_constraint(params, constraint, nteams):
@@ -65,6 +126,38 @@ def defense_constraint(params, constraint, nteams):
     return sum(params[nteams:nteams * 2]) / nteams - constraint
 
 
+def attack_constraint_jac(params, constraint, nteams):
+    """
+    Jacobian of the attack parameter constraint
+
+    :param params: Team Parameters (Attack, Defense and Home Rating)
+    :param constraint: The mean for attack
+    :param nteams: The number of teams
+    :return: Gradient of attack_constraint with respect to params
+    """
+
+    jac = np.zeros(len(params))
+    jac[:nteams] = 1 / nteams
+
+    return jac
+
+
+def defense_constraint_jac(params, constraint, nteams):
+    """
+    Jacobian of the defense parameter constraint
+
+    :param params: Team Parameters (Attack, Defense and Home Rating)
+    :param constraint: Mean for defense
+    :param nteams: The number of teams
+    :return: Gradient of defense_constraint with respect to params
+    """
+
+    jac = np.zeros(len(params))
+    jac[nteams:nteams * 2] = 1 / nteams
+
+    return jac
+
+
 def initial_guess(model, nteams):
     """
     Create an initial guess for the minimization function
@@ -110,6 +203,19 @@ def convert_abilities(opt, teams):
     return abilities
 
 
+def abilities_to_params(abilities, teams):
+    """
+    Convert an abilities dict back into the numpy array used by the minimization function
+    :param abilities: Dict of team abilities as created by convert_abilities
+    :param teams: Team names
+    :return: Numpy array of team abilities (Attack, Defense) and Home Advantage
+    """
+
+    return np.array([abilities['att'][team] for team in teams]
+                    + [abilities['def'][team] for team in teams]
+                    + [abilities['home_adv'][team] for team in teams], dtype=float)
+
+
 def home_accuracy(group):
     home_correct = sum((group.home_pts > group.away_pts) & (group.hprob > group.aprob))
     num_guesses = sum(group.hprob > group.aprob)
@@ -0,0 +1,201 @@
+""" Time decayed statistics of the training window, updated as the training date moves forward. """
+
+import numpy as np
+import pandas as pd
+from scipy.special import gammaln
+from models import nba_models as nba
+
+# The stored sums are rescaled once their exponents pass this so they can't overflow
+REBASE_EXPONENT = 50.0
+
+
+def day_numbers(dates):
+    """ Whole days since the epoch of datetimes. """
+
+    return np.asarray(dates, dtype='datetime64[D]').astype(np.int64)
+
+
+class DecayedSums:
+    """
+    Decayed sums of per-game statistics, by key, over the games in a rolling window before a date.
+
+    The weight exp(-decay * ceil(days / day_span)) is not multiplicative from one day to the next because of
+    the ceiling, but the ceiling rounds every game whose day is in the same class modulo day_span by the same
+    amount.  Within a class a weight is a factor of the game times a factor of the date, so the sums of each
+    class are stored with the game factors applied and moving to a new date only adds the new games, removes
+    the games that left the window and scales day_span arrays.
+    """
+
+    def __init__(self, days, keys, values, nkeys, day_span, decay, window):
+        """
+        :param days: Day number of each game, sorted
+        :param keys: Key index of each game
+        :param values: Array (games x statistics) of the statistics to sum
+        :param nkeys: Number of keys
+        :param day_span: Number of days in each time decay period
+        :param decay: Time decay factor
+        :param window: Games are kept for this many days
+        """
+
+        self.days = np.asarray(days, dtype=np.int64)
+        self.keys = np.asarray(keys, dtype=np.intp)
+        self.values = np.asarray(values, dtype=float)
+
+        self.day_span = day_span
+        self.rate = decay / day_span
+        self.window = window
+
+        self.sums = np.zeros((day_span, nkeys, self.values.shape[1]))
+        self.counts = np.zeros((day_span, nkeys), dtype=np.int64)
+
+        # Day the stored exponents are relative to
+        self.reference = self.days[0] if len(self.days) else 0
+
+        self.date = None
+        self.added = 0
+        self.dropped = 0
+
+    def _update(self, start, end, sign):
+        """ Add (sign 1) or remove (sign -1) games start to end. """
+
+        if start >= end:
+            return
+
+        days = self.days[start:end]
+        index = (days % self.day_span, self.keys[start:end])
+
+        scaled = self.values[start:end] * np.exp(self.rate * (days - self.reference))[:, None]
+
+        np.add.at(self.sums, index, sign * scaled)
+        np.add.at(self.counts, index, sign)
+
+    def advance(self, date):
+        """
+        Move the window to end before a date.
+
+        :param date: New current date, can't be before the previous one
+        :return: Positions of the games that were added
+        """
+
+        day = int(day_numbers([date])[0])
+
+        if self.date is not None and day < self.date:
+            raise ValueError('Dates must not decrease, %s is before the current date' % date)
+
+        self.date = day
+
+        exponent = self.rate * (day - self.reference)
+        if exponent > REBASE_EXPONENT:
+            self.sums *= np.exp(-exponent)
+            self.reference = day
+
+        start = self.added
+        self.added = np.searchsorted(self.days, day, side='left')
+        self._update(start, self.added, 1)
+
+        dropped = min(np.searchsorted(self.days, day - self.window, side='right'), self.added)
+        self._update(self.dropped, dropped, -1)
+        self.dropped = dropped
+
+        # Keys without games are exactly empty instead of what is left after the subtractions
+        self.sums[self.counts == 0] = 0
+
+        return start, self.added
+
+    def totals(self):
+        """
+        Decayed sums at the current date.
+
+        :return: Array (keys x statistics) of sums and the number of games of each key
+        """
+
+        offset = (np.arange(self.day_span) - self.date) % self.day_span
+        factor = np.exp(-self.rate * (self.date - self.reference + offset))
+
+        return np.tensordot(factor, self.sums, axes=1), self.counts.sum(axis=0)
+
+
+class TeamStream:
+    """ Compressed Dixon Coles likelihoods of consecutive dates. """
+
+    def __init__(self, games, nteams, day_span, decay, window=730):
+        """
+        :param games: DataFrame of game results with team indices, sorted by date
+        :param nteams: Number of teams in dataset
+        :param day_span: Number of days in each time decay period
+        :param decay: Time decay factor
+        :param window: Games are kept for this many days
+        """
+
+        self.nteams = nteams
+
+        home_pts = games['home_pts'].values.astype(float)
+        away_pts = games['away_pts'].values.astype(float)
+
+        values = np.column_stack([np.ones(len(games)), home_pts, away_pts,
+                                  gammaln(home_pts + 1) + gammaln(away_pts + 1)])
+
+        keys = games['home_team'].values.astype(np.intp) * nteams + games['away_team'].values.astype(np.intp)
+
+        self.sums = DecayedSums(day_numbers(games['date'].values), keys, values, nteams * nteams,
+                                day_span, decay, window)
+
+    def likelihood(self, date):
+        """
+        :param date: Train with the games before this date
+        :return: DixonColes with one row per (home team, away team) pair
+        """
+
+        self.sums.advance(date)
+        totals, counts = self.sums.totals()
+
+        pairs = np.flatnonzero(counts)
+        weight, home_pts, away_pts, log_factorial = totals[pairs].T
+
+        return nba.DixonColes.from_pairs(pairs // self.nteams, pairs % self.nteams, weight, home_pts, away_pts,
+                                         log_factorial.sum(), self.nteams)
+
+
+class PlayerStream:
+    """ Beta likelihood statistics of every player for consecutive dates. """
+
+    def __init__(self, players, day_span, decay, window=730):
+        """
+        :param players: DataFrame of player results without zero points, sorted by date
+        :param day_span: Number of days in each time decay period
+        :param decay: Time decay factor
+        :param window: Games are kept for this many days
+        """
+
+        self.codes, self.names = pd.factorize(players['player'], sort=True)
+        self.player_teams = players['team'].values
+
+        share = (players['pts'] / players['team_pts']).values
+
+        values = np.column_stack([np.ones(len(share)), np.log(share), np.log1p(-share), share, share * share])
+
+        self.sums = DecayedSums(day_numbers(players['date'].values), self.codes, values, len(self.names),
+                                day_span, decay, window)
+
+        # Team of each player's latest game
+        self.teams = np.empty(len(self.names), dtype=object)
+
+    def stats(self, date):
+        """
+        :param date: Train with the games before this date
+        :return: Names of the players in the window, the teams of their latest games and the tuple of
+                 nba_models.player_beta_stats arrays
+        """
+
+        start, end = self.sums.advance(date)
+
+        if start < end:
+            # Unique on the reversed games finds each player's last game
+            codes = self.codes[start:end][::-1]
+            players, last = np.unique(codes, return_index=True)
+            self.teams[players] = self.player_teams[start:end][::-1][last]
+
+        totals, counts = self.sums.totals()
+        players = np.flatnonzero(counts)
+
+        return self.names[players], self.teams[players], tuple(totals[players].T)
@@ -0,0 +1,127 @@
+""" Compressed on-disk archive of raw scraped pages, keyed by url. """
+
+import gzip
+import hashlib
+import json
+import os
+import time
+
+# Pages are kept out of the repository, the location can be changed with NBA_PAGE_ARCHIVE
+ARCHIVE_DIR = os.environ.get('NBA_PAGE_ARCHIVE',
+                             os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'page_archive'))
+
+# When offline, pages are only served from the archive and the network is never used
+OFFLINE = os.environ.get('NBA_OFFLINE', '0') == '1'
+
+
+def set_offline(offline=True):
+    """
+    Serve every page from the archive, for re-parsing scraped seasons without the network
+
+    :param offline: True to stop using the network
+    """
+
+    global OFFLINE
+    OFFLINE = offline
+
+
+def _path(url):
+    """ Archive path of a url without the extension. """
+
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    return os.path.join(ARCHIVE_DIR, key[:2], key)
+
+
+def read(url):
+    """
+    Archived page
+
+    :param url: Page url
+    :return: Tuple of the page content and its metadata (etag, last_modified), or None if it is not archived
+    """
+
+    path = _path(url)
+
+    try:
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        with gzip.open(path + '.html.gz', 'rb') as f:
+            content = f.read()
+    except (IOError, ValueError):
+        return None
+
+    return content, meta
+
+
+def write(url, content, headers=None):
+    """
+    Archive a page, the files are replaced atomically so concurrent scrapers never read a partial page
+
+    :param url: Page url
+    :param content: Page content
+    :param headers: Response headers, the validators are kept for conditional requests
+    """
+
+    headers = headers or {}
+    path = _path(url)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    meta = {'url': url,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'fetched': time.time()}
+
+    suffix = '.%d.tmp' % os.getpid()
+
+    with gzip.open(path + '.html.gz' + suffix, 'wb') as f:
+        f.write(content)
+
+    os.replace(path + '.html.gz' + suffix, path + '.html.gz')
+    _write_meta(path, meta)
+
+
+def touch(url, meta):
+    """
+    Mark an archived page as fetched now, after the server said it was not modified
+
+    :param url: Page url
+    :param meta: Archived page metadata, the validators are kept
+    :return: Updated metadata
+    """
+
+    meta = dict(meta, fetched=time.time())
+
+    _write_meta(_path(url), meta)
+
+    return meta
+
+
+def _write_meta(path, meta):
+    """ Replace the metadata of an archived page atomically. """
+
+    suffix = '.%d.tmp' % os.getpid()
+
+    with open(path + '.json' + suffix, 'w') as f:
+        json.dump(meta, f)
+
+    os.replace(path + '.json' + suffix, path + '.json')
+
+
+def conditional_headers(meta):
+    """
+    Request headers to revalidate an archived page
+
+    :param meta: Archived page metadata
+    :return: Dict of If-None-Match and If-Modified-Since headers
+    """
+
+    headers = {}
+
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    return headers
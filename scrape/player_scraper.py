@@ -1,10 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import re
-import requests
+import time
 from bs4 import BeautifulSoup
-from db import mongo
+import instrumentation
+from db import mongo, snapshot
 from scrape import scrape_utils
 
+BOX_SCORE_URL = 'https://www.basketball-reference.com/boxscores/%s.html'
+
 
 def get_starting_lineups(team, year):
     """
@@ -23,16 +27,17 @@ def get_starting_lineups(team, year):
     # Starting Lineup URL
     url = "http://www.basketball-reference.com/teams/%s/%s_start.html" % (team, year)
 
-    response = requests.get(url)
-    response.raise_for_status()
+    content = scrape_utils.get_page(url, final=scrape_utils.season_final(year))
 
-    soup = BeautifulSoup(response.content, "html.parser")
+    soup = BeautifulSoup(content, "html.parser")
 
     team = scrape_utils.rename_team(team)
 
     # Line up table
     lineup_table = soup.find(id='starting_lineups').find('tbody')
 
+    writer = mongo_wrapper.bulk('game_log')
+
     # Iterate through each game
     for game in lineup_table.find_all('tr', {'class': None}):
 
@@ -62,9 +67,10 @@ def get_starting_lineups(team, year):
             lineup.append(player['href'].rsplit('/', 1)[-1].rsplit('.', 1)[0])
 
         # Update document
-        mongo_wrapper.update('game_log',
-                             {'date': date, 'home.team': home, 'away.team': away},
-                             {'$set': {key: lineup}})
+        writer.update({'date': date, 'home.team': home, 'away.team': away},
+                      {'$set': {key: lineup}})
+
+    writer.flush()
 
 
 def player_per_game(player):
@@ -75,8 +81,7 @@ def player_per_game(player):
 
     # Request
     url = "http://www.basketball-reference.com" + player['url']
-    response = requests.get(url)
-    soup = BeautifulSoup(response.content, "html.parser")
+    soup = BeautifulSoup(scrape_utils.get_page(url), "html.parser")
 
     # Player's statistics
     per_game = soup.find(id="per_game").find('tbody')
@@ -126,36 +131,130 @@ def player_box_score(game_id):
     """
 
     # HTML Content
-    response = requests.get('https://www.basketball-reference.com/boxscores/' + game_id + '.html')
-    soup = BeautifulSoup(response.content, "html.parser")
+    content = scrape_utils.get_page(BOX_SCORE_URL % game_id, final=scrape_utils.game_final(game_id))
+    home_players, away_players = parse_box_score(content)
 
     # MongoDB Collection
     mongo_wrapper = mongo.Mongo()
 
-    # The ids of the tables have team names in them
-    table_id = re.compile('^box_[a-z]{3}_basic$')
+    # Insert into database
+    mongo_wrapper.update('game_log',
+                         {'_id': game_id},
+                         {'$set': {'hplayers': home_players, 'aplayers': away_players}})
+
+    # The game may be older than the player results snapshot
+    snapshot.invalidate('player_results', scrape_utils.game_date(game_id))
+
+
+def player_box_scores(game_ids, concurrency=4, rate=0.33, retries=3):
+    """
+    Scrape the box scores of many games, downloading several pages at once while parsing the pages
+    that have already arrived.  Basketball reference asks for no more than 20 requests a minute, so the
+    default rate stays just under it.
+
+    :param game_ids: MongoDB and Basketball Reference game ids
+    :param concurrency: Maximum number of downloads in progress at once
+    :param rate: Maximum requests per second
+    :param retries: Retries for each page
+    :return: Dict with the number of pages, failed game ids, seconds and pages per second
+    """
+
+    limiter = scrape_utils.RateLimiter(rate)
+    mongo_wrapper = mongo.Mongo()
+
+    failed = []
+    written = []
+    pages = 0
+    start = time.monotonic()
+
+    with ThreadPoolExecutor(concurrency) as executor, mongo_wrapper.bulk('game_log') as writer:
+
+        downloads = {executor.submit(scrape_utils.get_page, BOX_SCORE_URL % game_id, limiter, retries,
+                                     final=scrape_utils.game_final(game_id)): game_id
+                     for game_id in game_ids}
+
+        # Parse each page in this thread as soon as it is downloaded
+        for download in as_completed(downloads):
+            game_id = downloads[download]
+
+            try:
+                content = download.result()
+                with instrumentation.stage('scrape.parse_box_score'):
+                    home_players, away_players = parse_box_score(content)
+            except Exception as e:
+                print(game_id, e)
+                failed.append(game_id)
+                continue
+
+            writer.update({'_id': game_id}, {'$set': {'hplayers': home_players, 'aplayers': away_players}})
+            written.append(game_id)
+
+            pages += 1
+            if pages % 100 == 0:
+                print('%d box scores, %.2f pages/s' % (pages, pages / (time.monotonic() - start)))
+
+    # Games older than the player results snapshot are fetched again on its next load
+    if written:
+        snapshot.invalidate('player_results', min(scrape_utils.game_date(game_id) for game_id in written))
+
+    seconds = time.monotonic() - start
+    instrumentation.count('scrape.parse_box_score', 'pages', pages)
+    instrumentation.count('scrape.parse_box_score', 'failed', len(failed))
+
+    stats = {'pages': pages, 'failed': failed, 'seconds': seconds,
+             'pages_per_second': pages / seconds if seconds > 0 else 0.0}
+
+    print('%d box scores in %.1f s (%.2f pages/s), %d failed' % (pages, seconds, stats['pages_per_second'], len(failed)))
+
+    return stats
+
+
+def parse_box_score(content, fast=True):
+    """
+    Player stats from a box score page
+
+    :param content: HTML content of the box score
+    :param fast: Parse only the basic box score tables with lxml if True, otherwise the whole page with BeautifulSoup
+    :return: Lists of home and away player stats
+    """
+
+    # Each table is a list of players, each player is their id and a list of (stat name, stat value)
+    if fast:
+        tables = []
+        for table in scrape_utils.html_tables(content, 'box_[a-z]{3}_basic'):
+            players = [player for player in table.find('.//tbody').iter('tr') if player.get('class') is None]
+            stats = scrape_utils.parse_stat_rows(
+                [[(stat.get('data-stat'), scrape_utils.cell_string(stat)) for stat in player.iter('td')]
+                 for player in players])
+            tables.append(zip([next(player.iter('th')).get('data-append-csv') for player in players], stats))
+    else:
+        soup = BeautifulSoup(content, "html.parser")
+
+        # The ids of the tables have team names in them
+        table_id = re.compile('^box_[a-z]{3}_basic$')
+
+        tables = [[(player.find('th')['data-append-csv'],
+                    [(stat['data-stat'], scrape_utils.stat_parse(stat['data-stat'], stat.string))
+                     for stat in player.find_all('td')])
+                   for player in table.find('tbody').find_all('tr', {'class': None})]
+                  for table in soup.find_all(id=table_id)]
 
     home_players = []
     away_players = []
 
     home = False
 
-    for table in soup.find_all(id=table_id):
-        sub_table = table.find('tbody')
+    for table in tables:
 
-        for player in sub_table.find_all('tr', {'class': None}):
+        for player_id, stats in table:
 
             player_stats = {}
 
-            # Player ID
-            player_id = player.find('th')
-            player_id = player_id['data-append-csv']
-
             player_stats['player'] = player_id
 
             # Loop through each stat
-            for stat in player.find_all('td'):
-                player_stats[stat['data-stat']] = scrape_utils.stat_parse(stat['data-stat'], stat.string) # pylint: disable=line-too-long
+            for stat_name, stat in stats:
+                player_stats[stat_name] = stat
 
             # If this key exists it means the player did not play
             if 'reason' not in player_stats:
@@ -167,7 +266,4 @@ def player_box_score(game_id):
 
         home = True
 
-    # Insert into database
-    mongo_wrapper.update('game_log',
-                         {'_id': game_id},
-                         {'$set': {'hplayers': home_players, 'aplayers': away_players}})
+    return home_players, away_players
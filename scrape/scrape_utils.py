@@ -1,7 +1,174 @@
 import string
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timedelta
+import re
 import requests
+import lxml.html
+from lxml import etree
 from bs4 import BeautifulSoup
+import instrumentation
+from scrape import page_archive
+
+
+class RateLimiter:
+    """
+    Token bucket shared by scraping threads so requests stay under a fixed rate.
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: Requests allowed per second
+        :param burst: Requests that can be made at once after being idle
+        """
+
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Block until a request is allowed. """
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def get_page(url, limiter=None, retries=3, backoff=2.0, final=None):
+    """
+    Download a page through the page archive, retrying with exponential backoff on connection errors,
+    rate limiting and server errors
+
+    Pages of finished games and past seasons can't change, so a copy archived after the page became final
+    is served straight from the archive.  Any other archived page, including one archived before it became
+    final, is revalidated with a conditional request and only downloaded again if it changed.
+
+    :param url: Page url
+    :param limiter: RateLimiter to wait on before each request
+    :param retries: Number of retries after the first attempt
+    :param backoff: Seconds to wait before the first retry, doubled for each retry after
+    :param final: Datetime after which the page can no longer change, None if it can always change
+    :return: Page content
+    :raise requests.RequestException: If the last attempt fails or the page does not exist
+    :raise IOError: If the archive is offline and does not have the page
+    """
+
+    archived = page_archive.read(url)
+
+    if archived is not None and (page_archive.OFFLINE or is_final_copy(archived[1], final)):
+        instrumentation.count('scrape.get_page', 'archived')
+        return archived[0]
+
+    if page_archive.OFFLINE:
+        raise IOError('%s is not in the page archive' % url)
+
+    headers = page_archive.conditional_headers(archived[1]) if archived is not None else {}
+
+    for attempt in range(retries + 1):
+
+        if limiter is not None:
+            limiter.acquire()
+
+        try:
+            with instrumentation.stage('scrape.get_page'):
+                response = requests.get(url, headers=headers, timeout=30)
+            response.raise_for_status()
+
+            # Not modified since it was archived, the copy now counts as fetched at this time
+            if response.status_code == 304:
+                instrumentation.count('scrape.get_page', 'not_modified')
+                page_archive.touch(url, archived[1])
+                return archived[0]
+
+            instrumentation.count('scrape.get_page', 'downloaded')
+            instrumentation.count('scrape.get_page', 'bytes', len(response.content))
+
+            page_archive.write(url, response.content, response.headers)
+            return response.content
+
+        except requests.RequestException as e:
+            # Client errors other than too many requests will not change with a retry
+            status = e.response.status_code if e.response is not None else None
+            if attempt == retries or (status is not None and status < 500 and status != 429):
+                raise
+
+        time.sleep(backoff * 2 ** attempt)
+
+
+def current_season():
+    """
+    NBA season currently being played, seasons are named by the year they end in
+
+    :return: Season year
+    """
+
+    today = datetime.now()
+
+    # New seasons start in October
+    if today.month >= 10:
+        return today.year + 1
+
+    return today.year
+
+
+def game_date(game_id):
+    """
+    Date a game was played
+
+    :param game_id: Basketball Reference game id, starting with the date of the game (ex. 201810160BOS)
+    :return: Datetime at midnight of the game day
+    """
+
+    return datetime.strptime(game_id[:8], '%Y%m%d')
+
+
+def game_final(game_id):
+    """
+    When a game's pages can no longer change
+
+    :param game_id: Basketball Reference game id, starting with the date of the game (ex. 201810160BOS)
+    :return: Midnight after the game was played
+    """
+
+    return game_date(game_id) + timedelta(days=1)
+
+
+def season_final(year):
+    """
+    When a season's pages can no longer change
+
+    :param year: Season year
+    :return: July 1st of the year the season ends in, after the finals
+    """
+
+    return datetime(year, 7, 1)
+
+
+def is_final_copy(meta, final):
+    """
+    Determine if an archived page was fetched after it could no longer change
+
+    :param meta: Archived page metadata
+    :param final: Datetime after which the page can no longer change, None if it can always change
+    :return: True if the archived copy never needs to be revalidated
+    """
+
+    if final is None or meta.get('fetched') is None:
+        return False
+
+    return datetime.fromtimestamp(meta['fetched']) >= final
 
 
 def team_names():
@@ -14,8 +181,7 @@ def team_names():
     # Url for all teams in the NBA
     url = 'http://www.basketball-reference.com/teams/'
 
-    r = requests.get(url)
-    soup = BeautifulSoup(r.content, "html.parser")
+    soup = BeautifulSoup(get_page(url), "html.parser")
 
     # Page also lists defunct franchises, only want currently active teams
     active_teams = soup.find(id="teams_active")
@@ -39,8 +205,7 @@ def get_active_players():
     # Iterate through each letter of the alphabet
     for letter in string.ascii_lowercase:
         url = "http://www.basketball-reference.com/players/%s/" % letter
-        r = requests.get(url)
-        soup = BeautifulSoup(r.content, "html.parser")
+        soup = BeautifulSoup(get_page(url), "html.parser")
 
         # Not every letter is represented by a player
         try:
@@ -154,6 +319,24 @@ def field_goal_update(player, stat, play, make):
         play['fta'] = 1
 
 
+# Seconds played at the end of each period, four 12 minute quarters then 5 minute overtimes
+PERIOD_END = [0] + [720 * quarter for quarter in range(1, 5)] + [2880 + 300 * overtime for overtime in range(1, 11)]
+
+
+def period_end(period):
+    """
+    Seconds played at the end of a period
+
+    :param period: Period number, 1-4 are quarters and 5 onwards are overtimes
+    :return: Seconds
+    """
+
+    if period < len(PERIOD_END):
+        return PERIOD_END[period]
+
+    return 2880 + 300 * (period - 4)
+
+
 def play_time(quarter, time_text):
     """
     Determine the exact time a play happens in a play by play log.
@@ -165,25 +348,11 @@ def play_time(quarter, time_text):
     """
 
     # There are two blank rows between quarters
-    if quarter == 2:
-        base = datetime.strptime("12:00", "%M:%S")
-    elif quarter == 4:
-        base = datetime.strptime("24:00", "%M:%S")
-    elif quarter == 6:
-        base = datetime.strptime("36:00", "%M:%S")
-    elif quarter == 8:
-        base = datetime.strptime("48:00", "%M:%S")
-    elif quarter == 10:
-        base = datetime.strptime("53:00", "%M:%S")
-    elif quarter == 12:
-        base = datetime.strptime("58:00", "%M:%S")
-    else:
-        base = datetime.strptime("1:03:00", "%H:%M:%S")
+    period = max(quarter // 2, 1)
 
     # Adjust the time
-    time = datetime.strptime(time_text, "%M:%S")
-    time = base - time
-    time = divmod(time.days * 86400 + time.seconds, 60)
+    minutes, seconds = time_text.split(':')
+    time = divmod(period_end(period) - int(minutes) * 60 - int(seconds), 60)
     time = time[0] + time[1] / 60
     return round(time, 2)
 
@@ -203,7 +372,7 @@ def stat_parse(stat_name, stat):
             return int(stat[0:2]) * 60 + int(stat[3:5])
         elif len(stat) < 4:
             return int(stat)
-        elif stat[0] == '.' or stat.string[1] == '.':
+        elif stat[0] == '.' or stat[1] == '.':
             return float(stat)
         else:
             return stat
@@ -211,3 +380,97 @@ def stat_parse(stat_name, stat):
         return 0
     except ValueError:
         return stat
+
+
+def stat_parse_column(stat_name, stats):
+    """
+    Parse every value of a scraped stat column, gives the same result as stat_parse on each value
+
+    :param stat_name: Stat Name
+    :param stats: List of Stat Values
+    :return: List of the statistics in the correct type
+    """
+
+    # Most columns are small integers, which can be converted without stat_parse's checks
+    if stat_name != 'mp' and all(stat is not None and 0 < len(stat) < 4 and
+                                 (stat.isdecimal() or (stat[0] == '-' and stat[1:].isdecimal()))
+                                 for stat in stats):
+        return [int(stat) for stat in stats]
+
+    return [stat_parse(stat_name, stat) for stat in stats]
+
+
+def parse_stat_rows(rows):
+    """
+    Parse table rows of scraped stats one column at a time
+
+    :param rows: List of rows, each a list of (stat name, stat value) in table order
+    :return: List of rows, each a list of (stat name, parsed value) in table order
+    """
+
+    columns = {}
+
+    for i, row in enumerate(rows):
+        for j, (stat_name, stat) in enumerate(row):
+            columns.setdefault(stat_name, []).append((i, j, stat))
+
+    parsed = [list(row) for row in rows]
+
+    for stat_name, cells in columns.items():
+        values = stat_parse_column(stat_name, [stat for _, _, stat in cells])
+        for (i, j, _), value in zip(cells, values):
+            parsed[i][j] = (stat_name, value)
+
+    return parsed
+
+
+def html_tables(content, table_id):
+    """
+    Parse only the tables with a given id out of a page, the rest of the page is never parsed
+
+    :param content: HTML content of the page
+    :param table_id: Regular expression the whole table id must match
+    :return: List of lxml table elements in page order
+    """
+
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', 'replace')
+
+    tables = []
+
+    for match in re.finditer(r'<table\b[^>]*\bid=["\'](?:%s)["\']' % table_id, content):
+        start = match.start()
+
+        # Tables inside comments are not part of the page until javascript adds them
+        if content.rfind('<!--', 0, start) > content.rfind('-->', 0, start):
+            continue
+
+        end = content.find('</table>', start) + len('</table>')
+        tables.append(lxml.html.fragment_fromstring(content[start:end]))
+
+    return tables
+
+
+def cell_string(element):
+    """
+    The single string inside an lxml element, the same as BeautifulSoup's Tag.string
+
+    :param element: lxml element
+    :return: The string, or None if the element does not contain exactly one string
+    """
+
+    while True:
+
+        # BeautifulSoup counts text between child tags as children
+        children = len(element) + (1 if element.text else 0) + sum(1 for child in element if child.tail)
+
+        if children != 1:
+            return None
+
+        if element.text:
+            return element.text
+
+        element = element[0]
+
+        if element.tag is etree.Comment:
+            return element.text
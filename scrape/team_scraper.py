@@ -1,13 +1,13 @@
 from datetime import datetime
 import re
-import requests
 import time
 from bs4 import BeautifulSoup
 import pandas as pd
 from selenium import webdriver
 
-from db import mongo
-from scrape import scrape_utils
+import instrumentation
+from db import mongo, snapshot
+from scrape import scrape_utils, player_scraper
 
 full_teams = ['Atlanta Hawks', 'Boston Celtics', 'Brooklyn Nets', 'Charlotte Hornets', 'Chicago Bulls',
               'Cleveland Cavaliers', 'Dallas Mavericks', 'Denver Nuggets', 'Detroit Pistons',
@@ -40,11 +40,9 @@ def scrape_all():
     # Game Information (Box Score and Play by Play)
     for year in range(2015, 2020):
         player_scraper.get_starting_lineups(year)
-        for game in m.find('game_log', {'season': year}, {'_id': 1}):
-            #team_scraper.play_by_play(game['_id'])
-            player_scraper.player_box_score(game['_id'])
-
-            print(game['_id'])
+        #for game in m.find('game_log', {'season': year}, {'_id': 1}):
+        #    team_scraper.play_by_play(game['_id'])
+        player_scraper.player_box_scores([game['_id'] for game in m.find('game_log', {'season': year}, {'_id': 1})])
 
 
 
@@ -75,33 +73,75 @@ def season_game_logs(team, year):
 
     # Get HTML content
     url = 'http://www.basketball-reference.com/teams/%s/%s/gamelog' % (team, year)
-    r = requests.get(url)
-    soup = BeautifulSoup(r.content, "html.parser")
-    season_stats = soup.find(id='tgl_basic')
-    games = season_stats.find('tbody')
+    content = scrape_utils.get_page(url, final=scrape_utils.season_final(year))
 
     # MongoDB Collection
     m = mongo.Mongo()
 
+    with instrumentation.stage('scrape.parse_game_logs'):
+        games = parse_game_logs(content, team, year)
+
+    instrumentation.count('scrape.parse_game_logs', 'games', len(games))
+
+    # Only the new games are inserted, their dates decide what the snapshots drop
+    existing = set(m.distinct('game_log', '_id', {'_id': {'$in': [game['_id'] for game in games]}}))
+    games = [game for game in games if game['_id'] not in existing]
+
+    # Insert into database
+    if m.insert_many('game_log', games) > 0:
+        # Back-filled games are older than the snapshots' high-water marks, so they are fetched again
+        since = min(game['date'] for game in games)
+        snapshot.invalidate('game_results', since)
+        snapshot.invalidate('player_results', since)
+
+
+def parse_game_logs(content, team, year, fast=True):
+    """
+    Game documents from a team's game log page
+
+    :param content: HTML content of the game log
+    :param team: Team the game log belongs to
+    :param year: Season in year
+    :param fast: Parse only the game log table with lxml if True, otherwise the whole page with BeautifulSoup
+    :return: List of game documents
+    """
+
+    if fast:
+        games = scrape_utils.html_tables(content, 'tgl_basic')[0].find('.//tbody')
+        rows = [game for game in games.iter('tr') if game.get('class') is None]
+
+        game_ids = [next(game.iter('a')).get('href')[-17:-5] for game in rows]
+        game_stats = scrape_utils.parse_stat_rows(
+            [[(stat.get('data-stat'), scrape_utils.cell_string(stat)) for stat in game.iter('td')] for game in rows])
+    else:
+        soup = BeautifulSoup(content, "html.parser")
+        season_stats = soup.find(id='tgl_basic')
+        games = season_stats.find('tbody')
+        rows = games.find_all('tr', {'class': None})
+
+        game_ids = [game.find('a')['href'][-17:-5] for game in rows]
+        game_stats = [[(stat['data-stat'], scrape_utils.stat_parse(stat['data-stat'], stat.string))
+                       for stat in game.find_all('td')] for game in rows]
+
     # To find opponent statistics
     opponent = re.compile('^opp_.*$')
 
+    results = []
+
     # Loop through every game in a team's season
-    for game in games.find_all('tr', {'class': None}):
+    for game_id, stats in zip(game_ids, game_stats):
 
         curr_team = {'team': team}
         opp_team = {}
 
         # Loop through each stat
-        for stat in game.find_all('td'):
-
-            stat_name = stat['data-stat']
+        for stat_name, stat in stats:
 
             # These are opponent stats
             if re.match(opponent, stat_name):
-                opp_team[stat_name[4:]] = scrape_utils.stat_parse(stat_name, stat.string)
+                opp_team[stat_name[4:]] = stat
             else:
-                curr_team[stat_name] = scrape_utils.stat_parse(stat_name, stat.string)
+                curr_team[stat_name] = stat
 
         # Remove unnecessary information
         del curr_team['game_season']
@@ -115,7 +155,7 @@ def season_game_logs(team, year):
         result = {'date': datetime.strptime(curr_team.pop('date_game'), "%Y-%m-%d"),
                   'season': year,
                   'result': scrape_utils.determine_home_win(curr_team['game_location'], curr_team.pop('game_result')),
-                  '_id': game.find('a')['href'][-17:-5]}
+                  '_id': game_id}
 
         # Place the teams in the correct spot depending on who is the home team
         if curr_team.pop('game_location') == 0:
@@ -125,8 +165,9 @@ def season_game_logs(team, year):
             result['home'] = opp_team
             result['away'] = curr_team
 
-        # Insert into database
-        m.insert('game_log', result)
+        results.append(result)
+
+    return results
 
 
 def play_by_play(game_id):
@@ -137,86 +178,99 @@ def play_by_play(game_id):
     """
 
     # HTML Content
-    r = requests.get('https://www.basketball-reference.com/boxscores/pbp/' + game_id + '.html')
-    soup = BeautifulSoup(r.content, "html.parser")
-    table = soup.find(id='pbp').find_all('tr')
-
+    content = scrape_utils.get_page('https://www.basketball-reference.com/boxscores/pbp/' + game_id + '.html',
+                                    final=scrape_utils.game_final(game_id))
     # MongoDB Collection
     m = mongo.Mongo()
 
-    pbp = {
-        'home': [],
-        'away': []
-    }
+    # Insert into database
+    m.update('game_log', {'_id': game_id}, {'$set': {'pbp': parse_play_by_play(content)}})
+
+
+# Events in a play by play cell, checked in order, the first keyword in the cell decides the event
+PLAY_EVENTS = [
+    ('makes', 'make'),
+    ('misses', 'miss'),
+    ('Defensive rebound', 'drb'),
+    ('Offensive rebound', 'orb'),
+    ('Turnover', 'turnover'),
+    ('foul', 'foul'),
+    ('timeout', 'timeout'),
+    ('enters', 'sub')
+]
+
+# Game clock in a play by play row (ex. 11:45.0)
+CLOCK_PATTERN = re.compile('^([0-9]{1,3}):([0-9]{2})\\.[0-9]$')
+
+# Columns stored for every play
+PLAY_COLUMNS = ['time', 'home', 'player', 'assist', 'points', 'fgm', 'fga', 'fg3m', 'fg3a', 'ftm', 'fta',
+                'drb', 'orb', 'turnover', 'foul', 'timeout', 'sub']
+
+
+def parse_play_by_play(content):
+    """
+    Plays from a play by play page in a single pass over the play by play table
+
+    :param content: HTML content of the play by play
+    :return: Dict of column arrays, one entry per play (home is 1 for the home team and 0 for the away team)
+    """
+
+    pbp = {column: [] for column in PLAY_COLUMNS}
 
     quarter = 0
-    pattern = re.compile('^[0-9]{1,3}:[0-9]{2}\.[0-9]{1}$')
 
-    for item in table:
+    for item in scrape_utils.html_tables(content, 'pbp')[0].iter('tr'):
 
         time = None
-        x = 0
-
+        home = None
         play = {}
 
         # Iterate through row of stats, each row has 6 columns one half for each team
-        for stat in item.find_all('td'):
-
-            x += 1
-
-            check = True
-
-            # A player scored
-            if "makes" in stat.text:
-                scrape_utils.field_goal_update(stat.find('a')['href'], stat.text, play, True)
-            # Player missed a shot
-            elif "misses" in stat.text:
-                scrape_utils.field_goal_update(stat.find('a')['href'], stat.text, play, False)
-            # Account for other basketball stats
-            elif "Defensive rebound" in stat.text:
-                if 'Team' not in stat.text:
-                    play['drb'] = 1
-            elif "Offensive rebound" in stat.text:
-                if 'Team' not in stat.text:
-                    play['orb'] = 1
-            elif "Turnover" in stat.text:
-                play['turnover'] = 1
-            elif "foul" in stat.text:
-                play['foul'] = 1
-            elif "timeout" in stat.text:
-                play['timeout'] = 1
-            elif "enters" in stat.text:
-                play['sub'] = 1
-            else:
-                check = False
+        for x, stat in enumerate(item.iter('td'), 1):
+
+            text = stat.text_content()
 
-            # Determine if home or away
-            if check is True:
+            for keyword, event in PLAY_EVENTS:
+                if keyword in text:
+                    break
+            else:
+                event = None
+
+            if event is not None:
+
+                # A player scored or missed a shot
+                if event == 'make' or event == 'miss':
+                    href = next(stat.iter('a')).get('href')
+                    scrape_utils.field_goal_update(href, text, play, event == 'make')
+                # Rebounds by the team are not counted
+                elif event == 'drb' or event == 'orb':
+                    if 'Team' not in text:
+                        play[event] = 1
+                else:
+                    play[event] = 1
+
+                # Determine if home or away
                 if x == 2:
-                    play['home'] = 0
+                    home = 0
                 elif x == 6:
-                    play['home'] = 1
-
-            # Different quarters including multiple overtimes
-            if pattern.match(stat.text):
-                time = scrape_utils.play_time(quarter, stat.text[:-2])
+                    home = 1
 
-        if play:
-            play['time'] = time
+            # Convert the game clock to the time played in the game, without the tenths of a second
+            if CLOCK_PATTERN.match(text):
+                time = scrape_utils.play_time(quarter, text[:-2])
 
-            if play['home'] == 1:
-                del play['home']
-                pbp['home'].append(play)
-            else:
-                del play['home']
-                pbp['away'].append(play)
+        if home is not None:
+            pbp['time'].append(time)
+            pbp['home'].append(home)
+            pbp['player'].append(play.get('player'))
+            for column in PLAY_COLUMNS[3:]:
+                pbp[column].append(play.get(column, 0))
 
-        # Going to next quarter
+        # Going to next quarter, there are two blank rows between quarters
         if time is None:
             quarter += 1
 
-    # Insert into database
-    m.update('game_log', {'_id': game_id}, {'$set': {'pbp': pbp}})
+    return pbp
 
 
 def team_season_stats(team):
@@ -228,25 +282,51 @@ def team_season_stats(team):
 
     # Get HTML Content
     url = 'http://www.basketball-reference.com/teams/%s/stats_per_game_totals.html' % team
-    r = requests.get(url)
-    soup = BeautifulSoup(r.content, "html.parser")
+    content = scrape_utils.get_page(url)
 
     # MongoDB Collection
     m = mongo.Mongo()
 
-    # Team's yearly stats are displayed in a table
-    season_stats = soup.find(id='stats').find('tbody')
+    # Add to MongoDB
+    for season in parse_team_season_stats(content):
+        m.insert('team_season', season)
+
+
+def parse_team_season_stats(content, fast=True):
+    """
+    Season documents from a team's season stats page
+
+    :param content: HTML content of the season stats
+    :param fast: Parse only the stats table with lxml if True, otherwise the whole page with BeautifulSoup
+    :return: List of season documents
+    """
+
+    # Each row is the season text and a list of (stat name, stat value)
+    if fast:
+        season_stats = scrape_utils.html_tables(content, 'stats')[0].find('.//tbody')
+        rows = [(next(year.iter('th')).text_content(),
+                 [(stat.get('data-stat'), scrape_utils.cell_string(stat)) for stat in year.iter('td')])
+                for year in season_stats.iter('tr') if year.get('class') is None]
+    else:
+        soup = BeautifulSoup(content, "html.parser")
+
+        # Team's yearly stats are displayed in a table
+        season_stats = soup.find(id='stats').find('tbody')
+        rows = [(year.find('th').text, [(stat['data-stat'], stat.string) for stat in year.find_all('td')])
+                for year in season_stats.find_all('tr', {'class': None})]
+
+    seasons = []
 
     # Iterate through each year
-    for year in season_stats.find_all('tr', {'class': None}):
+    for season_text, stats in rows:
 
-        season_year = year.find('th').text[0:4]
+        season_year = season_text[0:4]
         season_year = int(season_year) + 1
         season = {'year': season_year}
 
         # Loop through each stat
-        for stat in year.find_all('td'):
-            season[stat['data-stat']] = stat.string
+        for stat_name, stat in stats:
+            season[stat_name] = stat
 
         # Rename relocated teams
         season['team_id'] = scrape_utils.rename_team(season['team_id'])
@@ -257,10 +337,20 @@ def team_season_stats(team):
         for k in to_remove:
             season.pop(k, None)
 
-        # Add to MongoDB
-        m.insert('team_season', season)
+        seasons.append(season)
+
+    return seasons
 
 def scrape_betting_page(url, sel_browser=None, mongo_driver=None, game_date=None):
+    """
+    Scrape the money line odds of every game on a sportsbookreview page
+
+    :param url: Page url
+    :param sel_browser: Selenium browser to reuse, a new one is opened if None
+    :param mongo_driver: Mongo BulkWriter for game_log, odds are added to the games instead of returned
+    :param game_date: Date of the games on the page
+    :return: DataFrame of odds if mongo_driver is None
+    """
 
     team_names = scrape_utils.team_names()
 
@@ -372,7 +462,7 @@ def scrape_betting_page(url, sel_browser=None, mongo_driver=None, game_date=None
 
             if mongo_driver is not None:
                 sportsbook_odds = {'sportsbooks': [{'sportsbook': sb, 'home_odds':ho, 'away_odds': ao} for sb, ho, ao in zip(sportsbooks, home_odds, away_odds)]}
-                query = mongo_driver.update('game_log', {'date': game_date, 'home.team': home_team, 'away.team': away_team}, {'$set': {'odds': sportsbook_odds}})
+                mongo_driver.update({'date': game_date, 'home.team': home_team, 'away.team': away_team}, {'$set': {'odds': sportsbook_odds}})
             else:
 
                 sportsbook_odds = [{'sportsbook': sb, 'home_odds': ho, 'away_odds': ao, 'home_team': home_team, 'away_team': away_team} for sb, ho, ao in zip(sportsbooks, home_odds, away_odds)]
@@ -404,12 +494,15 @@ def betting_lines(year):
 
     browser = webdriver.Chrome('chromedriver')
 
-    # Iterate through each date in a season
-    for game_date in all_dates:
+    # Odds updates are sent in batches
+    with m.bulk('game_log') as writer:
+
+        # Iterate through each date in a season
+        for game_date in all_dates:
 
-        # Get URL
-        url = 'https://classic.sportsbookreview.com/betting-odds/nba-basketball/money-line/?date=' + datetime.strftime(game_date, '%Y%m%d')
+            # Get URL
+            url = 'https://classic.sportsbookreview.com/betting-odds/nba-basketball/money-line/?date=' + datetime.strftime(game_date, '%Y%m%d')
 
-        scrape_betting_page(url, browser, m, game_date)
+            scrape_betting_page(url, browser, writer, game_date)
 
     browser.close()
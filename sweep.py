@@ -0,0 +1,179 @@
+""" Train and score many model configurations from a single load of the game history. """
+
+import collections
+import itertools
+import multiprocessing
+import time
+import numpy as np
+import pandas as pd
+from basketball import nba_model
+from db import history, process_utils
+from models import prediction_utils as pu
+from models import streaming
+
+# History shared with the sweep worker processes
+_history = None
+
+
+def _init_worker(results):
+    """ Give a sweep worker process the history, forked workers share it without copying. """
+
+    global _history
+    _history = results
+
+
+def grid(decays, att_constraints, def_constraints, day_spans):
+    """
+    Every combination of the model parameters.
+
+    :param decays: Time decay factors
+    :param att_constraints: Mean attack constraints
+    :param def_constraints: Mean defence constraints
+    :param day_spans: Number of days in each time decay period
+    :return: List of (mw, att_constraint, def_constraint, day_span)
+    """
+
+    return list(itertools.product(decays, att_constraints, def_constraints, day_spans))
+
+
+def _abilities_frame(date, teams, params):
+    """ Abilities of one date shaped like datasets.team_abilities. """
+
+    nteams = len(teams)
+
+    return pd.DataFrame({'date': date,
+                         'team': teams,
+                         'attack': params[:nteams],
+                         'defence': params[nteams:nteams * 2],
+                         'home_adv': params[nteams * 2:nteams * 3]})
+
+
+def _fit_configs(args):
+    """
+    Train and score configurations that share a decay and day span in a sweep worker process.
+
+    The decayed statistics only depend on the decay and day span, so each date's likelihood is built once
+    and fit with every constraint.
+
+    :param args: Tuple of (mw, day_span, list of (att_constraint, def_constraint), dates, seasons, solver)
+    :return: List of leaderboard rows
+    """
+
+    mw, day_span, constraints, dates, seasons, solver = args
+
+    start = time.time()
+
+    models = []
+    for att_constraint, def_constraint in constraints:
+        model = nba_model.from_config(mw, att_constraint, def_constraint, day_span, solver)
+        model.history = _history
+        models.append(model)
+
+    teams = np.asarray(models[0].teams)
+    stream = streaming.TeamStream(_history.games, len(teams), day_span, mw)
+
+    params = [None] * len(models)
+    abilities = [[] for model in models]
+
+    for date in dates:
+        likelihood = stream.likelihood(date)
+
+        for i, model in enumerate(models):
+            # Each date starts from the configuration's previous date instead of the database
+            opt = model.train(date, warm_start = False, likelihood = likelihood, store = False, x0 = params[i])
+            params[i] = opt.x
+            abilities[i].append(_abilities_frame(date, teams, opt.x))
+
+    # Games to score, with team names like datasets.game_results
+    games = _history.games[_history.games['season'].isin(seasons)]
+    games = games.assign(home_team = teams[games['home_team'].values], away_team = teams[games['away_team'].values])
+
+    seconds = (time.time() - start) / len(models)
+
+    rows = []
+
+    for model, frames in zip(models, abilities):
+        model.abilities = pd.concat(frames, ignore_index = True)
+
+        predictions = model.predict(games)
+        accuracy = model.accuracy_by_season(predictions)
+
+        row = collections.OrderedDict([('mw', mw),
+                                       ('att_constraint', model.att_constraint),
+                                       ('def_constraint', model.def_constraint),
+                                       ('day_span', day_span),
+                                       ('s', accuracy['s'].sum()),
+                                       ('accuracy', pu.win_accuracy(predictions)),
+                                       ('games', len(predictions)),
+                                       ('seconds', seconds)])
+
+        for season, s in accuracy['s'].items():
+            row['s_%s' % season] = s
+
+        rows.append(row)
+
+    return rows
+
+
+def sweep(configs, seasons = (2017, 2018, 2019), jobs = 1, solver = 'SLSQP', results = None):
+    """
+    Train every configuration over the seasons and rank them by the log likelihood of the results.
+
+    Args:
+        configs: List of (mw, att_constraint, def_constraint, day_span)
+        seasons: Seasons to train and score
+        jobs: Number of worker processes
+        solver: Team ability solver of the models
+        results: history.History to use, loaded from the database if None
+
+    Returns:
+        DataFrame leaderboard, best configuration first
+    """
+
+    seasons = list(seasons)
+
+    if results is None:
+        results = history.History.load(teams = process_utils.name_teams(False, 30), players = False)
+
+    dates = results.dates(seasons)
+
+    # Configurations with the same decay and day span share their likelihoods
+    groups = collections.OrderedDict()
+    for mw, att_constraint, def_constraint, day_span in configs:
+        groups.setdefault((mw, day_span), []).append((att_constraint, def_constraint))
+
+    # Groups are split when there are fewer of them than workers
+    splits = max(1, int(np.ceil(jobs / len(groups))))
+
+    tasks = []
+    for (mw, day_span), constraints in groups.items():
+        size = max(1, int(np.ceil(len(constraints) / splits)))
+        for i in range(0, len(constraints), size):
+            tasks.append((mw, day_span, constraints[i:i + size], dates, seasons, solver))
+
+    rows = []
+
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _init_worker, (results,))
+        try:
+            for task_rows in pool.imap_unordered(_fit_configs, tasks):
+                rows.extend(task_rows)
+                print('Scored %d/%d configurations' % (len(rows), len(configs)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(results)
+        for task in tasks:
+            rows.extend(_fit_configs(task))
+            print('Scored %d/%d configurations' % (len(rows), len(configs)))
+
+    return pd.DataFrame(rows).sort_values('s', ascending = False).reset_index(drop = True)
+
+
+if __name__ == '__main__':
+
+    leaderboard = sweep(grid([0.022, 0.044, 0.088], [100, 'rolling'], [1], [7, 14]),
+                        jobs = multiprocessing.cpu_count())
+
+    print(leaderboard.to_string())